@@ -30,14 +30,20 @@
 import numpy as np
 import pandas as pd
 
+import os
+import io
+import copy
+import shutil
+import tempfile
 import random
 import glob
+import threading
+from time import perf_counter
 import collections
 
 from collections import deque
 from datetime import date,timedelta,datetime
 from igraph import *
-from geopy.distance import geodesic
 from joblib import Parallel, delayed
 
 from utilities import *
@@ -47,54 +53,110 @@ from utilities import *
 
 class COVID_19:
     class contact_network:
-        def __init__(self,folder,cores=1,chunks=4,rho=0.9,layers=5):
+        def __init__(self,folder,cores=1,chunks=4,rho=0.9,layers=5,distance_method='vincenty',storage='parquet',
+                     graph_format='both'):
             self.rho=0.9
             self.folder=folder
             self.chunks=chunks
             self.num_cores=cores
             self.layers=layers
+            #'vincenty' (same rows as geodesic at the 0.1 m cutoff) or 'haversine', see lib/distance_utils.py
+            self.distance_method=distance_method
+            #'parquet' (columnar, partitioned by day) or 'csv', see write_contacts
+            self.storage=storage
+            #'both' (default: gml for the notebooks and npz, see load_graph), 'npz' or 'gml'
+            self.graph_format=graph_format
         def distance(self,contacts):
-            distance=[]
-            for _,i in contacts.iterrows():
-                distance.append(geodesic((i['sourceLat_avg'],i['sourceLong_avg']), 
-                                    (i['targetLat_avg'],i['targetLong_avg'])).km*1000)
-            filetered_contacts=contacts[np.asarray(distance)>0.1]
+            #distance in meters between source and target, computed on whole columns
+            distance=contacts_distance(contacts,method=self.distance_method)
+            filetered_contacts=contacts[distance>0.1]
             return filetered_contacts
-        def threshold_pc(self,risky_contacts):
+        def high_probability_ids(self):
+            #sorted unique ids of the users with critical probability p>=rho
             final_edges= self.final_edges[self.final_edges['p']>=self.rho]
-            unique_ids_to_consider=np.concatenate([np.unique(final_edges['sourceId']),np.unique(final_edges['targetId'])])
-            final_list=risky_contacts[np.logical_or(np.isin(risky_contacts['sourceId'],unique_ids_to_consider),
-                                     np.isin(risky_contacts['targetId'],unique_ids_to_consider))]
+            return np.unique(np.concatenate([final_edges['sourceId'].to_numpy(),final_edges['targetId'].to_numpy()]))
+        def threshold_pc(self,risky_contacts,unique_ids_to_consider=None):
+            if unique_ids_to_consider is None:
+                unique_ids_to_consider=self.high_probability_ids()
+            #hash join of both ends of the contacts against the id set
+            unique_ids_to_consider=pd.Index(unique_ids_to_consider)
+            final_list=risky_contacts[np.logical_or(isin_ids(risky_contacts['sourceId'],unique_ids_to_consider),
+                                                    isin_ids(risky_contacts['targetId'],unique_ids_to_consider))]
             return final_list
-        def remove_grid(self):
+        def chunk_files(self):
+            #raw_data/chunk_<n>/<file>.csv for n<=self.chunks, in chunk order
+            chunks=[i for i in glob.glob(self.folder+'raw_data/chunk_*') if int(i.split('_')[-1])<=self.chunks]
+            return [glob.glob(i+'/*')[0] for i in sorted(chunks,key=lambda i:int(i.split('_')[-1]))]
+        def contacts_file(self,name,storage=None):
+            #raw_data/<name>.parquet or raw_data/<name>.csv. Without an explicit storage (reading),
+            #fall back to the csv table if the parquet one has not been generated
+            path=self.folder+'raw_data/'+name+('.parquet' if (storage or self.storage)=='parquet' else '.csv')
+            if storage==None and self.storage=='parquet' and not os.path.isdir(path) \
+               and os.path.isfile(self.folder+'raw_data/'+name+'.csv'):
+                return self.folder+'raw_data/'+name+'.csv'
+            return path
+        def export_csv(self,name='filtered_risky_contacts'):
+            #export a table of contacts stored as parquet to raw_data/<name>.csv
+            contacts=read_contacts(self.contacts_file(name))
+            return write_contacts(contacts,self.contacts_file(name,storage='csv'),fmt='csv')
+        def remove_grid(self,streaming=False,batch_size=500000):
+            if streaming:
+                return self.remove_grid_streaming(batch_size=batch_size)
             #upload all the chunks
             risky_contacts=[]
-            for i in glob.glob(self.folder+'raw_data/chunk_*'):
-                if int(i.split('_')[-1])<=self.chunks:
-                    risky_contacts.append(pd.read_csv(glob.glob(i+'/*')[0]))
+            for i in self.chunk_files():
+                risky_contacts.append(pd.read_csv(i))
             risky_contacts=pd.concat(risky_contacts)
             #remove grid: distance between source and target <=0.1
-            _contacts=np.array_split(risky_contacts, self.num_cores)
+            _contacts=split_frame(risky_contacts, self.num_cores)
             results=Parallel(n_jobs=self.num_cores)(delayed(self.distance)(i)  for i in _contacts)
             results=pd.concat(results) 
             try:
-                results.to_csv(self.folder+'raw_data/filtered_risky_contacts.csv') 
+                write_contacts(results,self.contacts_file('filtered_risky_contacts',storage=self.storage),fmt=self.storage)
                 print('filtered_risky_contacts saved in ',self.folder)
             except:
                 print('Error during the saving of the filtered_risky_contact...')  
             return -1
+        def remove_grid_streaming(self,batch_size=500000):
+            """ 
+                Same output of remove_grid, but each chunk is read in
+                batches of `batch_size` rows which are filtered and appended
+                to filtered_risky_contacts. At most one batch is held in
+                memory, whatever the number of chunks.
+                Returns to the list of per-chunk counters.
+            """
+            out_file=self.contacts_file('filtered_risky_contacts',storage=self.storage)
+            header,stats=True,[]
+            try:
+                for n,i in enumerate(self.chunk_files()):
+                    t0=perf_counter()
+                    rows_in,rows_out=0,0
+                    for batch in pd.read_csv(i,chunksize=batch_size):
+                        filtered=self.distance(batch)
+                        write_contacts(filtered,out_file,fmt=self.storage,append=not header)
+                        header=False
+                        rows_in+=len(batch)
+                        rows_out+=len(filtered)
+                    elapsed=perf_counter()-t0
+                    stats.append({'chunk':i,'rows_in':rows_in,'rows_out':rows_out,'seconds':elapsed,
+                                  'rows_per_second':rows_in/elapsed if elapsed>0 else np.nan})
+                    print(f'chunk {n+1}: {rows_in} rows read, {rows_out} kept, '
+                          f'{elapsed:.1f} s ({stats[-1]["rows_per_second"]:.0f} rows/s)')
+                print('filtered_risky_contacts saved in ',self.folder)
+            except:
+                print('Error during the saving of the filtered_risky_contact...')
+            return stats
         def filtering(self):
             print('loading risky contacts...')
-            risky_contacts=pd.read_csv(self.folder+'raw_data/filtered_risky_contacts.csv')
-            risky_contacts['sourceTime']=[pd.to_datetime(datetime.strptime(i[:-15], '%Y-%m-%d'))
-                                          for i in risky_contacts['sourceTime']]
-            self.final_edges=pd.read_csv(self.folder+'raw_data/final_edges.csv')
-            _contacts=np.array_split(risky_contacts,100)
+            risky_contacts=read_contacts(self.contacts_file('filtered_risky_contacts'))
+            risky_contacts['sourceTime']=risky_contacts['sourceTime'].dt.normalize()
+            self.final_edges=pd.read_csv(self.folder+'raw_data/final_edges.csv',usecols=['sourceId','targetId','p'])
             print('selecting users with critical probability > ',self.rho)
-            results=Parallel(n_jobs=self.num_cores)(delayed(self.threshold_pc)(i)  for i in _contacts)
-            results=pd.concat(results)
+            #the id set is computed once and joined with the whole table in a single pass
+            results=self.threshold_pc(risky_contacts,self.high_probability_ids())
             try: 
-                results.to_csv(self.folder+f'raw_data/filtered_risky_contacts_{self.rho}.csv')
+                write_contacts(results,self.contacts_file(f'filtered_risky_contacts_{self.rho}',storage=self.storage),
+                               fmt=self.storage)
                 print(f'filtered_risky_contacts__{self.rho} correctly saved in: ',self.folder)
             except:
                 print(f'problem during the saving of the filtered_risky_contacts_{self.rho}')
@@ -108,9 +170,8 @@ class COVID_19:
                 dt=dt+timedelta(days=2)
             return week
         def build_contact_network(self,ids,layers,i):
-            #create node dictionary
+            #all the nodes, ordered by layer
             all_nodes=np.concatenate([i[0] for i in ids if i!=[]])
-            ID_dict={j:i for i,j in enumerate(all_nodes)}
             #empt graph
             g = Graph()
             #Add vertices and properties as ids and layer
@@ -118,21 +179,17 @@ class COVID_19:
             g.vs['ids']=all_nodes
             g.vs['layer']=np.concatenate([ii*np.ones(len(i[0])) for ii,i in enumerate(ids) if i!=[]])
             # create edgelist   
-            edges,un,unique_connections_clean=[],[],[]
-            for f in layers:
-                edges+=[(ID_dict[i],ID_dict[j]) for i,j in zip(f[0]['sourceId'],f[0]['targetId']) if i!=j]
-            for j in edges:
-                if ((j[0],j[1]) not in un) and ((j[1],j[0]) not in un):
-                    un.append((j[0],j[1]))
-                    un.append((j[1],j[0]))
-                    unique_connections_clean.append((j[0],j[1]))  
+            node_index=pd.Index(all_nodes)
+            source=np.concatenate([node_index.get_indexer(f[0]['sourceId']) for f in layers])
+            target=np.concatenate([node_index.get_indexer(f[0]['targetId']) for f in layers])
+            #drop self loops and keep the first occurrence of each undirected edge
+            unique_connections_clean=unique_undirected_edges(source[source!=target],target[source!=target])
             #add edges
-            g.add_edges(unique_connections_clean)
+            g.add_edges(unique_connections_clean.tolist())
             #giant component
             g_c=g.components().giant()
             #count infected in the gcc
-            ifc=[]
-            _=[ifc.append(j) for j in g_c.vs['ids'] if j in ids[0][0]]
+            ifc=np.asarray(g_c.vs['ids'],dtype=object)[np.isin(g_c.vs['ids'],ids[0][0])]
             #kcore
             kcore,count=np.unique(g_c.coreness(),return_counts=True)
             ### info to save ###
@@ -140,55 +197,85 @@ class COVID_19:
                   len([i for i in g_c.degree()]),len([i for i in g_c.es()]),len(np.unique(ifc)),
                   kcore,count]
             #save graph
-            g_c.write_gml(self.folder+f'contact_networks/gc_{i}.gml')
-            g.write_gml(self.folder+f'contact_networks/g_{i}.gml')
+            if self.graph_format in ['npz','both']:
+                write_graph_npz(g_c,self.folder+f'contact_networks/gc_{i}.npz')
+                write_graph_npz(g,self.folder+f'contact_networks/g_{i}.npz')
+            if self.graph_format in ['gml','both']:
+                g_c.write_gml(self.folder+f'contact_networks/gc_{i}.gml')
+                g.write_gml(self.folder+f'contact_networks/g_{i}.gml')
             return table
+        def infection_layers(self,interactions,infected_ids):
+            """ 
+                Multi-source BFS from the infected users over the contacts
+                of a window. Returns to (ids,layers): ids[j][0] are the sorted
+                unique ids at distance j from the infected (j=0..self.layers),
+                layers[j][0] the contacts touching ids[j][0] (j<self.layers).
+            """
+            m=len(interactions)
+            codes,names=pd.factorize(np.concatenate([interactions['sourceId'].to_numpy(),
+                                                     interactions['targetId'].to_numpy()]))
+            src,tgt=codes[:m],codes[m:]
+            indptr,indices=csr_adjacency(src,tgt,len(names))
+            sources=np.flatnonzero(isin_ids(names,infected_ids))
+            layer=multi_source_bfs(indptr,indices,sources,self.layers)
+            ids=[[np.unique(names[layer==j])] for j in range(self.layers+1)]
+            layer_src,layer_tgt=layer[src],layer[tgt]
+            layers=[[interactions[np.logical_or(layer_src==j,layer_tgt==j)]] for j in range(self.layers)]
+            return ids,layers
+        def window_network(self,i,interactions,infected_ids):
+            #0..self.layers layer contacts and network of the i-th window
+            ids,layers=self.infection_layers(interactions,infected_ids)
+            return self.build_contact_network(ids,layers,i)
         def contacts_network(self,start,final,days,window=7):
             infected_list=pd.read_csv(self.folder+'infected_list/Infected_list.csv')#self.in_folder+'Filtered_Matching.csv')
             infected_list['date']=[pd.to_datetime(datetime.strptime(i, '%Y-%m-%d')) 
                                        for i in infected_list['date']]
-            final_list=pd.read_csv(self.folder+f'raw_data/filtered_risky_contacts_{self.rho}.csv')
-            final_list['sourceTime']=pd.to_datetime(final_list['sourceTime'])
             week=self.datapoints(start,final,days)
-            table=[]
-            for i,start in enumerate(week):
-                #select cotacts week
-                interactions=final_list[np.logical_and(final_list['sourceTime']>=start,
-                                                     final_list['sourceTime']<start+timedelta(days=window))]
-                print(start,start+timedelta(days=window))
-                #0 layer contacts
-                layer_0=interactions[np.logical_or(np.isin(interactions['sourceId'],infected_list['Mobile_id']),
-                              np.isin(interactions['targetId'],infected_list['Mobile_id']))]
-                all_ids=np.concatenate([np.unique(layer_0['sourceId']),np.unique(layer_0['targetId'])])
-                zero_layer_ids=np.unique(all_ids[np.isin(all_ids,infected_list['Mobile_id'])])
-                first_layer_ids=np.unique(all_ids[np.isin(all_ids,infected_list['Mobile_id'],invert=True)])
-                #j layer contacts
-                layers,ids=[],[]
-                for j in np.arange(0,self.layers,1):
-                    layers.append([])
-                    ids.append([])
-                    if j==0:
-                        ids.append([])
-                        layers[0].append(layer_0)
-                        ids[0].append(zero_layer_ids)
-                        ids[1].append(first_layer_ids)
-                    else:
-                        layers[j].append(interactions[np.logical_or(np.isin(interactions['sourceId'],ids[j]),
-                                          np.isin(interactions['targetId'],ids[j]))])
-                        all_ids=np.concatenate([np.unique(layers[j][0]['sourceId']),np.unique(layers[j][0]['targetId'])])
-                        ids[j+1].append(np.unique(all_ids[np.isin(all_ids,np.concatenate([i[0] for i in ids if i!=[]]),
-                                                      invert=True)]))
-                _table=self.build_contact_network(ids,layers,i)
-                table.append(_table)
-            np.save(self.folder+'/simulations_results/G_Statistic',table)
+            final_list=read_contacts(self.contacts_file(f'filtered_risky_contacts_{self.rho}'),
+                                     columns=['sourceId','targetId','sourceTime'],
+                                     start=week[0],end=week[-1]+timedelta(days=window))
+            #sorted once by sourceTime, each window is a slice found by binary search
+            final_list=time_indexed_contacts(final_list)
+            infected_ids=infected_list['Mobile_id'].to_numpy()
+            if self.num_cores==1:
+                table=[]
+                for i,start in enumerate(week):
+                    #select cotacts week
+                    interactions=final_list.window(start,start+timedelta(days=window))
+                    print(start,start+timedelta(days=window))
+                    table.append(self.window_network(i,interactions,infected_ids))
+            else:
+                #windows are independent: each worker gets only the slice of its window,
+                #builds the network and writes the gml files. Results come back in window order.
+                worker=COVID_19.contact_network(self.folder,layers=self.layers,graph_format=self.graph_format)
+                table=Parallel(n_jobs=self.num_cores,verbose=5)(
+                      delayed(worker.window_network)(i,final_list.window(start,start+timedelta(days=window)),infected_ids)
+                      for i,start in enumerate(week))
+            np.save(self.folder+'/simulations_results/G_Statistic',np.array(table,dtype=object))
             return -1
     class Percolation:
-        def __init__(self, g, radius,layers=None):
+        def __init__(self, g, radius,layers=None,betweenness='exact',epsilon=0.05,delta=0.1,recompute=1,seed=None,
+                     batch=1,stop_q=None,stop_G=None,resolution=1):
             self.g = g
             self.cut_off=0.0005
+            #nodes removed per step, stop once q>=stop_q or G<=stop_G, a point of G(q) every
+            #`resolution` removals (the last one is always kept). Integers are numbers of nodes,
+            #floats fractions of the initial network, see Percolation.count
+            self.batch=batch
+            self.stop_q=stop_q
+            self.stop_G=stop_G
+            self.resolution=resolution
             self.nodes_giant=len(g.degree())
             self.layers=layers
             self.rad=radius
+            #'exact' or 'approximate' (pivot sampling, error epsilon with probability 1-delta),
+            #computed every `recompute` removals, see Percolation.betweenness
+            self.btw_method=betweenness
+            self.epsilon=epsilon
+            self.delta=delta
+            self.recompute=recompute
+            self.rng=np.random.default_rng(seed)
+            self.btw_cache=None
         def get_ball_boundary(self,g,v_id,rad,num_vertices):
             """ 
                 Returns an array of nodes ids of the graph `G`
@@ -248,38 +335,130 @@ class COVID_19:
 
             return np.sum(boundary_degrees -1)*(k_v - 1)
 
-        def CI_graph(self,g):
+        def CI_graph(self,g,cores=1):
             """ 
                 Returns an array containing the CI
-                for each node in the network
+                for each node in the network, computed
+                in one pass on its CSR adjacency
+                (see collective_influence).
+            """
+            indptr,indices=graph_csr(g)
+            return collective_influence(indptr,indices,self.rad,cores=cores).tolist()
+        def core_tracker(self,g):
+            """ 
+                Returns to the incremental core decomposition
+                of `g`, to follow `g` while nodes are removed.
+            """
+            indptr,indices=graph_csr(g)
+            return kcore_tracker(indptr,indices,g.coreness())
+        def update_kcore(self,kcore,giant,removed,dropped):
+            """ 
+                Removes the vertex `removed` from the core
+                decomposition, and the vertices `dropped` with it
+                from the giant component. Returns to the coreness
+                of the giant component.
+            """
+            kcore.remove(removed)
+            kcore.discard(dropped[dropped!=removed])
+            return kcore.core[giant.vertices()]
+        def attack_heap(self,g,mode,giant):
+            """ 
+                Returns to (heap, degree): the max-heap of the degree
+                or CI of the nodes of `g` and their degree, indexed
+                as the vertices of the giant component tracker.
+            """
+            degree=g.degree()
+            if mode=='degree':
+                return lazy_max_heap(degree,giant.alive),degree
+            self.ci=ci_engine(giant.indptr,giant.indices,giant.alive)
+            return lazy_max_heap(self.ci.all(self.rad,degree),giant.alive),degree
+        def update_heap(self,heap,degree,giant,mode,ball):
+            """ 
+                Updates the heap after the removal of the center of
+                `ball` (nodes within rad+1 for CI, the neighbours for
+                degree): only these nodes can change their score.
             """
-            CI=[]
-            for i in g.vs["ids"]:
-                _ids=g.vs["ids"].index(i)
-                ci=self.compute_node_CI_numpy(_ids, g.copy(),  self.rad, len(g.degree()))
-                CI.append(ci)
-            return CI
-        def delete_node(self,g):
+            neighbours=[i for i,d in ball.items() if d==1]
+            for i in neighbours:
+                degree[i]-=1
+            if mode=='degree':
+                nodes=[i for i in neighbours if giant.alive[i]]
+                heap.update(nodes,[degree[i] for i in nodes])
+            else:
+                nodes=[i for i in ball if giant.alive[i]]
+                heap.update(nodes,self.ci.all(self.rad,degree,nodes))
+        def betweenness(self,g):
+            """ 
+                Returns to the betweenness of the nodes of `g`, exact
+                or approximated by pivot sampling. With recompute=k
+                it is computed every k calls, in between the last
+                values of the nodes left are returned.
+            """
+            if self.btw_cache is not None and self.btw_age<self.recompute:
+                self.btw_age+=1
+                return [self.btw_cache[i] for i in g.vs['ids']]
+            if self.btw_method=='approximate':
+                btw=approximate_betweenness(g,self.epsilon,self.delta,self.rng)
+            else:
+                btw=g.betweenness(directed=False)
+            self.btw_cache,self.btw_age=dict(zip(g.vs['ids'],btw)),1
+            return btw
+        def delete_node(self,g,coreness=None,btw=None):
             """ 
                 Returns to the ids of the node in the higest kcore
-                with highest value of BC       
+                with highest value of BC (None if all are zero).
+                `coreness` and `btw` of `g` are computed if not given.
+            """
+            coreness=g.coreness() if coreness is None else coreness
+            btw=g.betweenness(directed=False) if btw is None else btw
+            _ids=argmax_core_score(coreness,btw)
+            return None if _ids is None else g.vs[_ids]['ids']
+
+        def count(self,x):
+            #number of nodes: integers as they are, floats as fractions of the initial network
+            if x is None or isinstance(x,(int,np.integer)):
+                return x
+            return max(1,int(round(x*self.nodes_giant)))
+        def stop(self,gc_fraq,removed):
+            if gc_fraq <= (self.cut_off if self.stop_G is None else max(self.cut_off,self.stop_G)):
+                return True
+            return self.stop_q is not None and removed>=self.count(self.stop_q)
+        def record(self,Giant_dimension,q,gc_fraq,removed,last=False):
+            #appends the point (q, G) at the chosen resolution, `last` is always kept
+            if removed>q[-1] and (last or removed-q[-1]>=self.count(self.resolution)):
+                Giant_dimension.append(gc_fraq)
+                q.append(removed)
+        def select_batch(self,g,mode,size,giant,heap=None,shell=None):
+            """ 
+                Returns to the `size` vertices (as in the giant
+                component tracker) with the highest scores of the
+                mode, all of them computed on the current `g`.
             """
-            dicti_idsbtw,dicti_idsshell={},{}
-            for i,ii,jj in zip(g.vs['ids'],g.coreness(),g.betweenness(directed=False)):
-                dicti_idsshell[i]=ii
-                dicti_idsbtw[i]=jj
-            maximum=0
-            for i,j in zip(dicti_idsshell.values(),dicti_idsshell.keys()):
-                if i==np.max(list(dicti_idsshell.values())):
-                    if dicti_idsbtw[j] >maximum:
-                        ids=j 
-                        maximum=dicti_idsbtw[j]
-            return ids
-
-        def percolation(self,mode='random',g=None):
+            if mode in ['degree','CI']:
+                return heap.pop(size)
+            vertices=giant.vertices()
+            if mode=='random':
+                return vertices[random.sample(range(len(vertices)),min(size,len(vertices)))].tolist()
+            if mode=='betweeness':
+                score=np.asarray(self.betweenness(g))
+                if self.layers!=None:
+                    score=np.where(np.asarray(g.vs['layer'])<=self.layers,score,0)
+            elif mode=='closeness':
+                score=np.asarray(g.closeness())
+                if np.isnan(score).any():
+                    return []
+            else:
+                score=np.asarray(self.betweenness(g) if mode=='KC+BC' else g.degree(),dtype=np.float64)
+                #highest kcore first, then highest score
+                return vertices[np.lexsort((-score,-shell))[:size]].tolist()
+            return vertices[np.argsort(-score,kind='stable')[:size]].tolist()
+
+        def percolation(self,mode='random',g=None,offset=0):
             """ 
                 Main: returns to the vector
                 G(q) and q. The default mode=='random'
+                `offset`: nodes already removed from `g`,
+                counted for stop_q.
             """
             if g==None:
                 g = self.g.copy()
@@ -290,48 +469,66 @@ class COVID_19:
             gc_fraq= 1
             Giant_dimension.append(gc_fraq)
             q.append(removed)
+            giant=giant_tracker(*graph_csr(g))
+            self.btw_cache=None
+            heap=shell=None
+            if mode in ['degree','CI']:
+                heap,degree=self.attack_heap(g,mode,giant)
+            if mode in ['KC+BC','KC+HB']:
+                kcore=self.core_tracker(g)
+                shell=kcore.core[giant.vertices()]
+            batch=self.count(self.batch)
             try:
-                while gc_fraq > self.cut_off:
-                    #select name of the node with higest degree and get ids
-                    if mode=='random':
-                        _name=random.choice([i for i in g.vs['ids']])
-                        _ids=g.vs["ids"].index(_name)
-                    elif mode=='degree':
-                        _name=g.vs.select(_degree = g.maxdegree())['ids'][0]
-                        _ids=g.vs["ids"].index(_name)
-                    elif mode=='betweeness':
-                        _name,_ids=node_in_layer(g,layers=self.layers)
-                        #_name=g.vs.select(_betweenness = np.max(g.betweenness(directed=False)))['ids'][0]
-                        #_ids=g.vs["ids"].index(_name)  
-                    elif mode=='closeness':
-                        _name=g.vs.select(_closeness = np.max(g.closeness()))['ids'][0]
-                        _ids=g.vs["ids"].index(_name)  
-                    elif mode=='CI':
-                        CI=self.CI_graph(g)
-                        _ids=np.where(CI==np.max(CI))[0][0]
-                    elif mode=='KC+BC':
-                        _name= self.delete_node(g)
-                        _ids=g.vs["ids"].index(_name) 
-                    elif mode=='KC+HB':
-                        g.vs["shell"]=g.coreness()
-                        _names=g.vs.select(shell = np.max(g.coreness()))['ids']
-                        _max=0
-                        for s,ss in zip(g.degree(),g.vs['ids']):
-                            if ss in _names:
-                                if s>_max:
-                                    _max=s
-                                    _name=ss
-                        _ids=g.vs['ids'].index(_name) 
-                    #delete node
-                    g.delete_vertices(_ids)
-                    #recomupute giant component
-                    g=g.components().giant()
-                    gc_fraq=len(g.degree())/self.nodes_giant
-                    removed+=1
-                    Giant_dimension.append(gc_fraq)
-                    q.append(removed)
+                while not self.stop(gc_fraq,removed+offset):
+                    size=batch if self.stop_q is None else min(batch,self.count(self.stop_q)-removed-offset)
+                    if size>1 or heap is not None:
+                        #the heap modes pop the vertices: no position in g is needed
+                        targets=self.select_batch(g,mode,size,giant,heap,shell)
+                        if len(targets)==0:
+                            raise ValueError('no node left to remove')
+                    else:
+                        #select name of the node with higest degree and get ids
+                        if mode=='random':
+                            _ids=random.choice(range(len(g.degree())))
+                        elif mode=='betweeness':
+                            _name,_ids=node_in_layer(g,layers=self.layers,btw=self.betweenness(g))
+                            #_name=g.vs.select(_betweenness = np.max(g.betweenness(directed=False)))['ids'][0]
+                            #_ids=g.vs["ids"].index(_name)  
+                        elif mode=='closeness':
+                            #closeness is NaN on an isolated node
+                            closeness=np.asarray(g.closeness())
+                            _ids=None if np.isnan(closeness).any() else int(np.argmax(closeness))
+                        elif mode=='KC+BC':
+                            #highest BC in the highest kcore
+                            _ids=argmax_core_score(shell,self.betweenness(g))
+                        elif mode=='KC+HB':
+                            #highest degree in the highest kcore
+                            _ids=argmax_core_score(shell,g.degree())
+                        if _ids is None:
+                            raise ValueError('no node left to remove')
+                        targets=[giant.vertices()[_ids]]
+                    #delete the nodes and the pieces cut off from the giant component
+                    before=None if heap is not None else giant.alive.copy()
+                    for v in targets:
+                        if not giant.alive[v]:
+                            #already cut off by a node of the same batch
+                            continue
+                        if mode in ['degree','CI']:
+                            ball=csr_ball(giant.indptr,giant.indices,giant.alive,v,1 if mode=='degree' else self.rad+1)
+                        dropped=giant.remove(v)
+                        if mode in ['degree','CI']:
+                            self.update_heap(heap,degree,giant,mode,ball)
+                        if mode in ['KC+BC','KC+HB']:
+                            shell=self.update_kcore(kcore,giant,v,dropped)
+                        removed+=1
+                    if heap is None:
+                        g.delete_vertices((np.cumsum(before)[before & ~giant.alive]-1).tolist())
+                    #the heap modes only need the size of the giant component, g is not kept up to date
+                    gc_fraq=giant.size/self.nodes_giant
+                    self.record(Giant_dimension,q,gc_fraq,removed)
             except:
                    print('No GCC')
+            self.record(Giant_dimension,q,gc_fraq,removed,last=True)
             return Giant_dimension,q
 
         def by_kcore_betweenness(self,core_frac=0.55):
@@ -350,47 +547,233 @@ class COVID_19:
                     break
             # First part: Isolate k-core
             max_core = core_indexes[-1]
-            while max_core>=start_core:
+            tracker=self.core_tracker(g)
+            giant=giant_tracker(*graph_csr(g))
+            batch=self.count(self.batch)
+            while max_core>=start_core and not self.stop(gc_fraq,removed):
                 deg =[i for i in g.degree()]
-                # Select the right node in the core to remove.
-                node_to_remove = calculate_out_core(g, deg, start_core, kcore)
-                if node_to_remove>-1:
-                    g.delete_vertices(node_to_remove)
-                else:
+                size=batch if self.stop_q is None else min(batch,self.count(self.stop_q)-removed)
+                # Select the right nodes in the core to remove, all of them on the current g.
+                nodes_to_remove = out_core_nodes(g, deg, start_core, kcore, size)
+                if len(nodes_to_remove)==0:
                     break
-                g= g.components().giant()
-                removed+=1
-                Giant_dimension.append(len(g.degree())/self.nodes_giant)
-                q.append(removed)
-                kcore = g.coreness()
-                core_indexes = np.unique(kcore)
-                max_core = core_indexes[-1]
+                before=giant.alive.copy()
+                for v in giant.vertices()[nodes_to_remove]:
+                    if not giant.alive[v]:
+                        #already cut off by a node of the same batch
+                        continue
+                    dropped=giant.remove(v)
+                    kcore = self.update_kcore(tracker,giant,v,dropped)
+                    removed+=1
+                g.delete_vertices((np.cumsum(before)[before & ~giant.alive]-1).tolist())
+                gc_fraq=len(g.degree())/self.nodes_giant
+                self.record(Giant_dimension,q,gc_fraq,removed)
+                max_core = np.max(kcore,initial=0)
+            self.record(Giant_dimension,q,gc_fraq,removed,last=True)
+            if self.stop(gc_fraq,removed):
+                return Giant_dimension,q
 
             # Second part: Remove by betweenness.
             _sum=q[-1]
-            _GCC,_q=self.percolation(mode='betweeness',g=g)
+            _GCC,_q=self.percolation(mode='betweeness',g=g,offset=_sum)
             for i,j in zip(_GCC[1:],_q[1:]):
                 Giant_dimension.append(i)
                 q.append(j+_sum)
-            return  Giant_dimension,q   
+            return  Giant_dimension,q
+
+        def static_percolation(self,mode='random',seed=None):
+            """
+                Returns to G(q) and q for a removal order computed
+                once on the whole network: mode=='random', 'degree'
+                or 'CI' (initial degree or CI, highest first).
+                The giant component is computed for all q at once,
+                adding the nodes back in reverse order.
+            """
+            g=self.g
+            if mode=='random':
+                order=np.random.default_rng(seed).permutation(g.vcount())
+            elif mode=='degree':
+                order=np.argsort(-np.asarray(g.degree()),kind='stable')
+            elif mode=='CI':
+                order=np.argsort(-np.asarray(self.CI_graph(g)),kind='stable')
+            else:
+                raise ValueError(f"mode '{mode}' has no static order, use percolation")
+            sizes=reverse_percolation(*graph_csr(g),order)
+            Giant_dimension=sizes/self.nodes_giant
+            #same stopping rule and resolution as percolation
+            end=next((i for i in range(len(sizes)) if self.stop(Giant_dimension[i],i)),len(sizes)-1)
+            q=list(range(0,end+1,self.count(self.resolution)))
+            if q[-1]!=end:
+                q.append(end)
+            return Giant_dimension[q].tolist(),q
+
+    class percolation_ensemble:
+        """ 
+            Runs Percolation for (network, mode, seed) jobs on a pool
+            of workers. The (q, G) points of all the curves are appended
+            to one binary array, indexed by a csv table with offset,
+            length and wall time of each job: a run can be resumed.
+        """
+        modes=['random','degree','CI','closeness','betweeness','KC+BC','KC+HB','kcore_betweenness']
+        columns=['network','mode','seed','offset','length','seconds']
+        def __init__(self,folder,radius=2,cores=1,name='ensemble',graph_format='npz',pattern=None,
+                     layers=None,**options):
+            self.folder=folder
+            self.rad=radius
+            self.num_cores=cores
+            self.name=name
+            #'npz' or 'gml', as written by contact_network (graph_format)
+            self.pattern=f'contact_networks/gc_*.{graph_format}' if pattern is None else pattern
+            self.layers=layers
+            #forwarded to Percolation, e.g. betweenness='approximate'
+            self.options=options
+        def networks(self):
+            #{name: path} of the networks folder+pattern, e.g. {'gc_0': .../gc_0.npz}
+            paths=sorted(glob.glob(self.folder+self.pattern),key=lambda i:int(i.split('_')[-1].split('.')[0]))
+            return {os.path.basename(i).split('.')[0]:i for i in paths}
+        def jobs(self,networks=None,modes=None,seeds=1):
+            """ 
+                Returns to the list of (network, mode, seed). `seeds`
+                (a number or a list of seeds) applies to the random
+                mode and to approximate betweenness, the other modes
+                are deterministic and run once with seed 0.
+            """
+            networks=list(self.networks()) if networks is None else networks
+            modes=self.modes if modes is None else modes
+            seeds=range(seeds) if isinstance(seeds,int) else seeds
+            stochastic=['random']
+            if self.options.get('betweenness')=='approximate':
+                stochastic+=['betweeness','KC+BC','kcore_betweenness']
+            return [(i,j,k) for i in networks for j in modes for k in (seeds if j in stochastic else [0])]
+        def run_job(self,job,path):
+            t0=perf_counter()
+            network,mode,seed=job
+            random.seed(seed)
+            P=COVID_19.Percolation(load_graph(path),self.rad,layers=self.layers,seed=seed,**self.options)
+            Giant_dimension,q=P.by_kcore_betweenness() if mode=='kcore_betweenness' else P.percolation(mode)
+            return job,np.column_stack([q,Giant_dimension]).astype(np.float64),perf_counter()-t0
+        def files(self):
+            return (self.folder+f'simulation_results/percolation_{self.name}_curves.bin',
+                    self.folder+f'simulation_results/percolation_{self.name}_index.csv')
+        def load(self):
+            """ 
+                Returns to (table, curves): one row per job done
+                (network, mode, seed, offset, length, seconds) and the
+                (points x 2) array of (q, G), the curve of a job
+                being curves[offset:offset+length].
+            """
+            curves_file,index_file=self.files()
+            if not os.path.isfile(index_file):
+                return pd.DataFrame(columns=self.columns),np.zeros((0,2))
+            #a row truncated by a crash is dropped
+            text=complete_lines(index_file)
+            if not text:
+                return pd.DataFrame(columns=self.columns),np.zeros((0,2))
+            table=pd.read_csv(io.StringIO(text),header=None,names=self.columns,on_bad_lines='skip').dropna()
+            table=table.astype({'seed':int,'offset':int,'length':int}).reset_index(drop=True)
+            points=int((table['offset']+table['length']).max()) if len(table) else 0
+            return table,np.fromfile(curves_file,dtype=np.float64,count=2*points).reshape(-1,2)
+        def curve(self,network,mode,seed=0,store=None):
+            #G(q) and q of a job, as returned by Percolation.percolation
+            table,curves=self.load() if store is None else store
+            row=table[(table['network']==network)&(table['mode']==mode)&(table['seed']==seed)].iloc[0]
+            points=curves[row['offset']:row['offset']+row['length']]
+            return points[:,1].tolist(),points[:,0].astype(int).tolist()
+        def run(self,networks=None,modes=None,seeds=1,resume=False,verbose=True):
+            """ 
+                Runs the jobs (see jobs) on self.num_cores workers and
+                returns to load(). Each curve is stored as soon as its
+                job finishes; with resume=True the jobs already in the
+                index are skipped.
+            """
+            curves_file,index_file=self.files()
+            os.makedirs(os.path.dirname(curves_file),exist_ok=True)
+            if resume:
+                if os.path.isfile(index_file):
+                    truncate_incomplete_line(index_file)
+                table,curves=self.load()
+                done=set(zip(table['network'],table['mode'],table['seed']))
+                #points written after the last indexed job (crash) are dropped
+                if os.path.isfile(curves_file):
+                    os.truncate(curves_file,curves.nbytes)
+                offset=len(curves)
+                print(f'{len(done)} jobs found in {index_file}')
+            else:
+                done,offset=set(),0
+                for i in [curves_file,index_file]:
+                    if os.path.isfile(i):
+                        os.remove(i)
+            paths=self.networks()
+            #largest networks first, so that no worker is left with a slow job at the end
+            jobs=sorted([i for i in self.jobs(networks,modes,seeds) if i not in done],
+                        key=lambda i:-os.path.getsize(paths[i[0]]))
+            t0=perf_counter()
+            for n,(job,points,seconds) in enumerate(Parallel(n_jobs=self.num_cores,return_as='generator_unordered')(
+                                                  delayed(self.run_job)(i,paths[i[0]]) for i in jobs)):
+                with open(curves_file,'ab') as f:
+                    f.write(points.tobytes())
+                with open(index_file,'a') as f:
+                    f.write(f'{job[0]},{job[1]},{job[2]},{offset},{len(points)},{seconds!r}\n')
+                offset+=len(points)
+                if verbose:
+                    print(f'{n+1}/{len(jobs)} {job[0]} {job[1]} seed {job[2]}: {len(points)} points in {seconds:.1f} s')
+            if verbose:
+                print(f'{len(jobs)} jobs done in {perf_counter()-t0:.1f} s')
+            return self.load()
 		
     class SIR:
-        def __init__(self, beta_max,folder,name,sampling=100,layer=0.0,cores=1):
+        #one row per (beta, seed): results of sampling, run_task and the checkpoint
+        results_dtype=np.dtype([('beta','f8'),('shell','f8'),('value','f8'),('idx','i8')])
+        def __init__(self, beta_max,folder,name,sampling=100,layer=0.0,cores=1,engine='python',seed=None,
+                     coupled=False):
             self.samplings=sampling
             self.beta = beta_max
             self.folder=folder
             self.layer=layer
             self.num_cores=cores
             self.name=name
+            #'python': original node by node simulation
+            #'fast': frontier updates on a CSR adjacency (see SIR_model_fast)
+            #'batched': all the realizations advanced together (see SIR_model_batched)
+            #'percolation': final sizes from bond percolation clusters (see percolation_sizes)
+            #coupled=True with 'percolation': one draw per edge shared by all the betas (see percolation_sweep)
+            self.coupled=coupled
+            self.engine=engine
+            self.seed=seed
+            self.rng=np.random.default_rng(seed)
+            self.csr=None
         def col(self,obj,i):
             if obj[i]==0:
                 obj[i]=1
+        def adjacency(self):
+            #CSR adjacency of self.g, built once per graph. The neighbours of a node are in
+            #increasing order, as g.neighbors: SIR_model draws in the order of the original code
+            if self.csr is None:
+                indptr,indices=graph_csr(self.g)
+                rows=np.repeat(np.arange(len(indptr)-1),np.diff(indptr))
+                self.csr=indptr,indices[np.lexsort((indices,rows))]
+            return self.csr
+        def edges(self):
+            #every undirected edge once, as (src,tgt) arrays with src<tgt
+            indptr,indices=self.adjacency()
+            src=np.repeat(np.arange(len(indptr)-1),np.diff(indptr))
+            return src[src<indices],indices[src<indices]
         def SIR_model(self,node,_beta):
+            return np.mean(self.final_sizes(node,_beta))
+        def final_sizes(self,node,_beta):
+            #final outbreak size (I+R) of each of the self.samplings realizations
+            if self.engine=='fast':
+                return self.SIR_model_fast(node,_beta)
+            elif self.engine=='batched':
+                return self.SIR_model_batched(node,_beta)
+            elif self.engine=='percolation':
+                return self.SIR_model_percolation(node,_beta)
+            indptr,indices=self.adjacency()
             #zero stays for S
             M=[]
             for _ in range(self.samplings):
                 #color = np.zeros(len(self.g.get_out_degrees(self.g.get_vertices())), dtype=np.int32)
-                color = np.zeros(len([i for i in self.g.degree()]), dtype=np.int32)
+                color = np.zeros(len(indptr)-1, dtype=np.int32)
                 #activate the first node
                 _colors=[self.col(color,i) for i in node]
                 I=np.where(color==1)[0]
@@ -398,59 +781,359 @@ class COVID_19:
                 while len(I)>0:
                     for j in I:
                         #ramification of each neighbour
-                        ##this nhbs is here because the function g.get_all_neighbors(j) does not work##
-                        ##in principle it would be enough to use g.get_all_neighbors(j)##
-                        nhbs=self.g.neighbors(j)#self.g.get_out_neighbors(j)
+                        #neighbours of j on the CSR adjacency (as self.g.neighbors(j))
+                        nhbs=indices[indptr[j]:indptr[j+1]].tolist()
                         _infected_nodes=[i for i in nhbs if (random.random() < _beta and color[j]==1)]
                         _colors=[self.col(color,i) for i in _infected_nodes]
                         color[j]=2
                     I=np.where(color==1)[0]
                     R=np.where(color==2)[0]
                 M.append(len(I)+len(R))
-            return np.mean(M)
-        def sampling(self,beta_range):
+            return np.asarray(M)
+        def SIR_model_fast(self,node,_beta):
+            """ 
+                Same process of SIR_model: every generation each infected
+                node infects each susceptible neighbour with probability
+                _beta and then recovers. The whole frontier is expanded at
+                once on the CSR adjacency, with one batch of random draws
+                per generation and int8 states (0=S, 1=I, 2=R).
+            """
+            indptr,indices=self.adjacency()
+            M=np.zeros(self.samplings,dtype=np.int64)
+            for r in range(self.samplings):
+                state=np.zeros(len(indptr)-1,dtype=np.int8)
+                frontier=np.unique(np.asarray(node,dtype=np.int64))
+                state[frontier]=1
+                size=len(frontier)
+                while len(frontier)>0:
+                    nbs=csr_neighbors(indptr,indices,frontier)
+                    nbs=nbs[self.rng.random(len(nbs))<_beta]
+                    state[frontier]=2
+                    frontier=np.unique(nbs[state[nbs]==0])
+                    state[frontier]=1
+                    size+=len(frontier)
+                M[r]=size
+            return M
+        def SIR_model_batched(self,node,_beta):
+            """ 
+                Runs the self.samplings realizations of SIR_model_fast
+                simultaneously on a (samplings x N) int8 state matrix.
+                The frontier is the set of (realization, node) infected
+                pairs and each generation uses a single random draw for
+                all of them. Returns to the final size of each realization.
+            """
+            indptr,indices=self.adjacency()
+            N,R=len(indptr)-1,self.samplings
+            state=np.zeros((R,N),dtype=np.int8)
+            seeds=np.unique(np.asarray(node,dtype=np.int64))
+            fr_r,fr_v=np.repeat(np.arange(R),len(seeds)),np.tile(seeds,R)
+            state[fr_r,fr_v]=1
+            while len(fr_v)>0:
+                counts=indptr[fr_v+1]-indptr[fr_v]
+                nbs=csr_neighbors(indptr,indices,fr_v)
+                nbs_r=np.repeat(fr_r,counts)
+                hit=self.rng.random(len(nbs))<_beta
+                nbs,nbs_r=nbs[hit],nbs_r[hit]
+                state[fr_r,fr_v]=2
+                new=nbs_r*N+nbs
+                new=np.unique(new[state[nbs_r,nbs]==0])
+                fr_r,fr_v=new//N,new%N
+                state[fr_r,fr_v]=1
+            return np.count_nonzero(state,axis=1)
+        def percolation_sizes(self,_beta):
+            """ 
+                The final size of an outbreak of SIR_model started from v is
+                distributed as the cluster of v in a bond percolated graph
+                with occupation probability _beta. For each of the
+                self.samplings realizations an edge mask is drawn and the
+                components are labeled once with union-find. Returns to the
+                (samplings x N) matrix of final sizes from every node.
+            """
+            N=len(self.adjacency()[0])-1
+            src,tgt=self.edges()
+            sizes=np.zeros((self.samplings,N),dtype=np.int32)
+            for r in range(self.samplings):
+                occupied=self.rng.random(len(src))<_beta
+                labels=union_find_labels(N,src[occupied],tgt[occupied])
+                sizes[r]=np.bincount(labels,minlength=N)[labels]
+            return sizes
+        def percolation_sweep(self,beta_range):
+            """ 
+                Coupled version of percolation_sizes over the whole grid
+                beta_range: every edge gets one uniform draw u per realization
+                and it is occupied for all the betas with u<beta. Clusters are
+                grown incrementally adding the edges in order of u, so the
+                whole curve costs about as one beta. Per realization the sizes
+                are monotone in beta. Returns to the (len(beta_range) x N)
+                matrix of mean final sizes from every node.
+            """
+            N=len(self.adjacency()[0])-1
+            src,tgt=self.edges()
+            betas=np.sort(np.asarray(beta_range,dtype=np.float64))
+            sizes=np.zeros((len(betas),N),dtype=np.float64)
+            for r in range(self.samplings):
+                u=self.rng.random(len(src))
+                order=np.argsort(u)
+                bounds=np.searchsorted(u[order],betas)
+                parent,added=np.arange(N),0
+                for k,b in enumerate(bounds):
+                    parent=union_find_merge(parent,src[order[added:b]],tgt[order[added:b]])
+                    added=b
+                    sizes[k]+=np.bincount(parent,minlength=N)[parent]
+            #back to the order of beta_range
+            sizes=sizes/self.samplings
+            return sizes[np.searchsorted(betas,beta_range)]
+        def SIR_model_percolation(self,node,_beta):
+            #final sizes of the outbreaks started from all the nodes in `node` together
+            N=len(self.adjacency()[0])-1
+            src,tgt=self.edges()
+            M=np.zeros(self.samplings,dtype=np.int64)
+            for r in range(self.samplings):
+                occupied=self.rng.random(len(src))<_beta
+                labels=union_find_labels(N,src[occupied],tgt[occupied])
+                M[r]=np.sum(np.bincount(labels,minlength=N)[np.unique(labels[np.asarray(node)])])
+            return M
+        def compare_engines(self,g,betas=(0.05,0.1,0.2,0.3),nodes=None,samplings=None,seed=0,engine='fast'):
+            """ 
+                Statistical equivalence check of the 'fast' (or 'batched') engine against
+                the original one: for each (beta, seed node) the two samples
+                of final sizes are compared with a two-sample KS test.
+                With the default 5 nodes x 4 betas at least one p-value below
+                0.01 is expected about 20% of the times under the null hypothesis.
+                The simulations run on a new SIR instance, self is not modified.
+            """
+            rng=np.random.default_rng(seed)
+            nodes=rng.choice(g.vcount(),5,replace=False) if nodes is None else nodes
+            samplings=self.samplings if samplings is None else samplings
+            sir=COVID_19.SIR(self.beta,self.folder,self.name,sampling=samplings,layer=self.layer)
+            sir.g,sir.n_nodes,sir.rng=g,g.vcount(),rng
+            table=[]
+            for _beta in betas:
+                for v in nodes:
+                    sir.engine='python'
+                    reference=sir.final_sizes([int(v)],_beta)
+                    sir.engine=engine
+                    fast=sir.final_sizes([int(v)],_beta)
+                    D,p=ks_2samp(reference,fast)
+                    table.append([_beta,int(v),np.mean(reference),np.mean(fast),D,p])
+            return pd.DataFrame(table,columns=['beta','node','mean_python',f'mean_{engine}','ks_D','p_value'])
+        def sampling(self,beta_range,seed=None):
+            if seed is not None:
+                #independent stream for each worker
+                self.rng=np.random.default_rng(seed)
             results=[]
-            for _beta in beta_range:
+            if self.engine=='percolation' and self.coupled:
+                sweep=self.percolation_sweep(beta_range)
+            for ii,_beta in enumerate(beta_range):
+                if self.engine=='percolation':
+                    #mean final size from every node at once
+                    sizes=sweep[ii] if self.coupled else np.mean(self.percolation_sizes(_beta),axis=0)
                 for _shells in np.unique(self.infected_net.shell):
                     _shell=self.infected_net[np.isin(self.infected_net.shell,_shells)]
                     #SIR starting from each of this ids
                     for _idx in _shell.idx:
-                        results.append([_beta,_shells,self.SIR_model([int(_idx)],_beta)])
+                        if self.engine=='percolation':
+                            results.append((_beta,_shells,sizes[int(_idx)],_idx))
+                        else:
+                            results.append((_beta,_shells,self.SIR_model([int(_idx)],_beta),_idx))
+            return np.array(results,dtype=self.results_dtype)
+        def tasks(self,beta_range,target_seconds=0.5,done=None):
+            """ 
+                Generator of the (beta, shells, idxs) tasks of beta_range,
+                most expensive first: betas in decreasing order and seeds by
+                decreasing degree. The number of seeds of each task is chosen
+                when the task is dispatched, from the cost per seed measured
+                on the tasks already completed (see cost_estimate), so that
+                each task lasts about target_seconds. The percolation engine
+                computes all the seeds of a beta at once: (beta, None, None),
+                or all the betas for the coupled sweep. The (beta, idx) pairs
+                in `done` (see load_checkpoint) are skipped.
+            """
+            done=set() if done is None else done
+            betas=np.sort(np.asarray(beta_range))[::-1]
+            net=self.infected_net[np.argsort(-self.infected_net.k,kind='stable')]
+            shells,idxs=net.shell,net.idx
+            if self.engine=='percolation':
+                betas=[_beta for _beta in betas if any((round(_beta,10),_idx) not in done for _idx in idxs)]
+                if self.coupled and len(betas)>0:
+                    yield (tuple(betas),None,None)
+                elif not self.coupled:
+                    for _beta in betas:
+                        yield (_beta,None,None)
+                return
+            for _beta in betas:
+                todo=np.asarray([(round(_beta,10),_idx) not in done for _idx in idxs],dtype=bool)
+                _shells,_idxs=shells[todo],idxs[todo]
+                start=0
+                while start<len(_idxs):
+                    per_seed=self.cost_estimate(_beta)
+                    size=1 if np.isnan(per_seed) else int(np.clip(target_seconds/max(per_seed,1e-6),1,len(_idxs)))
+                    yield (_beta,_shells[start:start+size],_idxs[start:start+size])
+                    start+=size
+        def cost_estimate(self,_beta):
+            #seconds per seed measured at _beta or, if not available yet, at the closest
+            #higher beta (an upper bound, betas are dispatched in decreasing order).
+            #Called from the thread dispatching the tasks while schedule updates self.costs
+            with self.costs_lock:
+                costs=dict(self.costs)
+            done=[b for b in costs if b>=_beta]
+            if not done:
+                return np.nan
+            seconds,seeds=costs[min(done)]
+            return seconds/seeds
+        def run_task(self,task,seed):
+            t0=perf_counter()
+            self.rng=np.random.default_rng(seed)
+            _beta,_shells,_idxs=task
+            if _idxs is None:
+                rows=self.sampling(np.atleast_1d(_beta))
+            else:
+                rows=np.array([(_beta,i,self.SIR_model([int(j)],_beta),j) for i,j in zip(_shells,_idxs)],
+                              dtype=self.results_dtype)
+            return task,rows,perf_counter()-t0
+        def lean_copy(self,folder):
+            """ 
+                Copy of self shipped to the workers: no graph, every engine
+                runs on the CSR adjacency, passed as read-only memory-mapped
+                files in `folder` which joblib forwards to the workers by
+                reference instead of pickling them.
+            """
+            worker=copy.copy(self)
+            #the cost estimates stay with the dispatcher (a lock cannot be pickled)
+            worker.costs,worker.costs_lock={},None
+            worker.g=None
+            worker.csr=[]
+            for name,array in zip(['indptr','indices'],self.adjacency()):
+                np.save(os.path.join(folder,name+'.npy'),array)
+                worker.csr.append(np.load(os.path.join(folder,name+'.npy'),mmap_mode='r'))
+            return worker
+        def schedule(self,beta_range,target_seconds=0.5,done=None):
+            """ 
+                Runs the tasks of beta_range on self.num_cores workers and
+                yields (task, rows, seconds) as soon as each task finishes.
+                Workers take a new task when they are free, so no worker is
+                stuck with all the supercritical betas. Tasks are dispatched
+                one at a time, each sized with the latest cost estimates.
+            """
+            self.costs,self.costs_lock={},threading.Lock()
+            seeds=np.random.SeedSequence(self.seed)
+            folder=tempfile.mkdtemp(prefix='SIR_')
+            try:
+                worker=self if self.num_cores==1 else self.lean_copy(folder)
+                for result in Parallel(n_jobs=self.num_cores,return_as='generator_unordered',batch_size=1)(
+                              delayed(worker.run_task)(i,seeds.spawn(1)[0]) for i in self.tasks(beta_range,target_seconds,done)):
+                    task,rows,seconds=result
+                    if task[2] is not None:
+                        with self.costs_lock:
+                            seconds_done,seeds_done=self.costs.get(task[0],(0.0,0))
+                            self.costs[task[0]]=(seconds_done+seconds,seeds_done+len(rows))
+                    yield result
+            finally:
+                shutil.rmtree(folder,ignore_errors=True)
+        def checkpoint_file(self):
+            return self.folder+f'simulations_results/SIR_{int(self.layer)}_{self.name}_checkpoint.csv'
+        def load_checkpoint(self):
+            #rows (beta,shell,value,idx) of the tasks already completed
+            if not os.path.isfile(self.checkpoint_file()):
+                return np.zeros(0,dtype=self.results_dtype)
+            #a row truncated by a crash is dropped
+            text=complete_lines(self.checkpoint_file())
+            if not text:
+                return np.zeros(0,dtype=self.results_dtype)
+            rows=pd.read_csv(io.StringIO(text),header=None,on_bad_lines='skip').dropna()
+            results=np.zeros(len(rows),dtype=self.results_dtype)
+            for ii,i in enumerate(self.results_dtype.names):
+                results[i]=rows[ii].to_numpy()
+            #rows of seeds outside the infected network (e.g. another run) are rejected
+            if getattr(self,'infected_net',None) is not None:
+                results=results[np.isin(results['idx'],self.infected_net.idx)]
             return results
-        def average_shell(self,results):
+        def scheduled_sampling(self,beta_range,verbose=True,resume=False):
+            """ 
+                Collects the results of schedule. Every task is appended to
+                the checkpoint file as soon as it finishes; with resume=True
+                the tasks already in the checkpoint are skipped and their
+                rows are returned with the new ones. Per task timing in
+                self.timings.
+            """
+            if resume:
+                if os.path.isfile(self.checkpoint_file()):
+                    truncate_incomplete_line(self.checkpoint_file())
+                results=[self.load_checkpoint()]
+                done={(round(i,10),j) for i,j in zip(results[0]['beta'].tolist(),results[0]['idx'].tolist())}
+                print(f'{len(results[0])} results found in the checkpoint')
+            else:
+                results,done=[],set()
+                if os.path.isfile(self.checkpoint_file()):
+                    os.remove(self.checkpoint_file())
+            os.makedirs(os.path.dirname(self.checkpoint_file()),exist_ok=True)
+            resumed,computed,timings=len(done),0,[]
+            t0=perf_counter()
+            for n,(task,rows,seconds) in enumerate(self.schedule(beta_range,done=done)):
+                with open(self.checkpoint_file(),'a') as f:
+                    f.write(''.join(f'{i[0]!r},{i[1]!r},{i[2]!r},{i[3]!r}\n' for i in rows.tolist()))
+                results.append(rows)
+                computed+=len(rows)
+                timings.append([task[0],len(rows),seconds])
+                if verbose and (n+1)%50==0:
+                    elapsed=perf_counter()-t0
+                    print(f'{n+1} tasks, {computed} seeds done in {elapsed:.1f} s ({computed/elapsed:.2f} seeds/s)')
+            self.timings=pd.DataFrame(timings,columns=['beta','seeds','seconds'])
+            self.throughput=computed/(perf_counter()-t0)
+            return np.concatenate(results) if results else np.zeros(0,dtype=self.results_dtype)
+        def partial_average(self,n_nodes=None):
+            #average_shell of the results in the checkpoint, also while the sweep is running
+            return self.average_shell(self.load_checkpoint(),n_nodes)
+        def shell_statistics(self,results,n_nodes=None):
+            """ 
+                Single pass aggregation of the results per (shell, beta) cell.
+                Returns to (mean, stderr, counts, shells, betas): mean and
+                standard error of the final size divided by the number of
+                nodes, and number of samples, as (shells x betas) matrices.
+            """
+            n_nodes=self.n_nodes if n_nodes==None else n_nodes
+            if results.dtype!=self.results_dtype:
+                #legacy list of [beta,shell,value,...] rows
+                rows=np.asarray(results,dtype=np.float64)
+                results=np.zeros(len(rows),dtype=self.results_dtype)
+                results['beta'],results['shell'],results['value']=rows[:,0],rows[:,1],rows[:,2]
+            shells,shell_idx=np.unique(results['shell'],return_inverse=True)
+            betas,beta_idx=np.unique(results['beta'],return_inverse=True)
+            cell=shell_idx*len(betas)+beta_idx
+            size=len(shells)*len(betas)
+            counts=np.bincount(cell,minlength=size)
+            sums=np.bincount(cell,weights=results['value'],minlength=size)
+            squares=np.bincount(cell,weights=results['value']**2,minlength=size)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                mean=sums/counts
+                var=(squares-counts*mean**2)/(counts-1)
+                stderr=np.sqrt(np.maximum(var,0)/counts)
+            shape=(len(shells),len(betas))
+            return mean.reshape(shape)/n_nodes,stderr.reshape(shape)/n_nodes,counts.reshape(shape),shells,betas
+        def average_shell(self,results,n_nodes=None):
             #This function compute the average infected population
             #for each shell. It return to a numpy vector.
-            res=pd.DataFrame(results)
-            _all=[]
-            for k in np.unique(res[1]):
-                _res=res[res[1]==k]
-                y=[]
-                for i in np.unique(res[0]):
-                    _res_1=_res[_res[0]==i]
-                    y.append(np.mean(_res_1[2]))
-                _all.append(np.divide(y,len(self.g.degree())))
-            _all.append(np.unique(res[0]))
-            return _all
-        def run_SIR(self,g):
-            self.g=g.copy()#Graph.Read_GML(in_folder)
-            ##get_total_degree does not work. To obtain it i sum over in and out ##
-            degree=[i for i in self.g.degree()]#self.g.get_out_degrees(self.g.get_vertices())
-            table=[]
-            #gt.kcore_decomposition(self.g)
-            for ii,i,j,k,l in zip(np.arange(0,len(degree)+1),self.g.vs['ids'],self.g.coreness(),degree, self.g.vs['layer']):
-                table.append([ii,i,j,k,l])
-            net=pd.DataFrame(table,columns=['idx','ids','shell','k','layer'])
-            net[['idx','shell', 'k','layer']] = net[['idx','shell', 'k','layer']].astype('float64')
-            self.infected_net=net[np.isin(net['layer'],np.arange(0,self.layer+1,1))]
-            if self.num_cores==1:
-                results=self.sampling(np.arange(0.0,self.beta,0.02))
-            else:    
-                betas_per_core=[np.arange(0.0,self.beta,0.02)[i::self.num_cores] for i in range(self.num_cores)]
-                results=Parallel(n_jobs=self.num_cores)(delayed(self.sampling)(i)  for i in betas_per_core)
-                results=np.concatenate(results)
+            if not isinstance(results,np.ndarray):
+                results=np.asarray(results,dtype=np.float64)
+            mean,_,_,_,betas=self.shell_statistics(results,n_nodes)
+            return [i for i in mean]+[betas]
+        def run_SIR(self,g,resume=False):
+            #the graph is only read: no copy, and the seeds table is made of plain arrays
+            self.g=g
+            self.csr=None
+            self.n_nodes=g.vcount()
+            layer=np.asarray(g.vs['layer'],dtype=np.float64)
+            net=np.rec.fromarrays([np.arange(self.n_nodes,dtype=np.float64),np.asarray(g.coreness(),dtype=np.float64),
+                                   np.asarray(g.degree(),dtype=np.float64),layer],names='idx,shell,k,layer')
+            self.infected_net=net[np.isin(layer,np.arange(0,self.layer+1,1))]
+            #every (beta,seeds) task is saved in the checkpoint as soon as it is done
+            results=self.scheduled_sampling(np.arange(0.0,self.beta,0.02),resume=resume)
             result=self.average_shell(results)
+            mean,stderr,counts,shells,betas=self.shell_statistics(results)
             try:
                 np.save(self.folder+f'simulations_results/SIR_{int(self.layer)}_'+self.name,result)
+                np.savez(self.folder+f'simulations_results/SIR_{int(self.layer)}_{self.name}_stats',
+                         mean=mean,stderr=stderr,counts=counts,shells=shells,betas=betas)
                 print('file succefully saved in:',self.folder+'/simulation_results')
             except:
                 print('Error during the saving:',self.folder+'/simulation_results')
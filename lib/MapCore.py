@@ -21,8 +21,16 @@ class MapCore:
         self.map = None
         self.cmap_name='hsv'
         
-        filtered_file = f'filtered_risky_contacts_{rho}.csv'
-        self.contact_table = pd.read_csv(os.path.join(self.out_folder, filtered_file))
+        # The parquet table (partitioned by day) is preferred to the csv export.
+        # Only the columns used to draw the map are loaded from it.
+        filtered_file = os.path.join(self.out_folder, f'filtered_risky_contacts_{rho}.parquet')
+        if os.path.isdir(filtered_file):
+            self.contact_table = pd.read_parquet(filtered_file, columns=['sourceId', 'targetId', 'sourceTime',
+                                                                         'sourceLat_avg', 'sourceLong_avg',
+                                                                         'targetLat_avg', 'targetLong_avg'])
+        else:
+            filtered_file = f'filtered_risky_contacts_{rho}.csv'
+            self.contact_table = pd.read_csv(os.path.join(self.out_folder, filtered_file))
         table_memory = sys.getsizeof(self.contact_table)/(10**6)
         if table_memory>memory_tol:
             print(f'Memory warning: table of contacts consuming {table_memory} MB of memory')
@@ -0,0 +1,90 @@
+'''
+    Vectorized distance kernels working on whole columns of
+    coordinates (degrees). All the distances are returned in meters.
+'''
+import numpy as np
+
+# Mean Earth radius (IUGG) and WGS-84 ellipsoid parameters.
+EARTH_RADIUS = 6371008.8
+WGS84_A = 6378137.0
+WGS84_F = 1/298.257223563
+WGS84_B = (1-WGS84_F)*WGS84_A
+
+def haversine_distance(lat1, lon1, lat2, lon2, radius=EARTH_RADIUS):
+    '''
+        Great-circle distance between the points (lat1, lon1) and
+        (lat2, lon2) on a sphere of radius 'radius'. The inputs can be
+        scalars or arrays of the same shape.
+    '''
+    lat1, lon1 = np.radians(lat1), np.radians(lon1)
+    lat2, lon2 = np.radians(lat2), np.radians(lon2)
+    h = np.sin((lat2-lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2
+    return 2*radius*np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+def vincenty_distance(lat1, lon1, lat2, lon2, max_iter=200, tol=1e-12):
+    '''
+        Vincenty's inverse formula on the WGS-84 ellipsoid, iterated on
+        all the pairs at once. It agrees with geopy's geodesic to the
+        sub-millimeter level. Pairs that do not converge within 'max_iter'
+        iterations (nearly antipodal points) are returned as NaN.
+    '''
+    lat1, lon1 = np.radians(np.asarray(lat1, dtype=np.float64)), np.radians(np.asarray(lon1, dtype=np.float64))
+    lat2, lon2 = np.radians(np.asarray(lat2, dtype=np.float64)), np.radians(np.asarray(lon2, dtype=np.float64))
+    L = lon2-lon1
+    U1 = np.arctan((1-WGS84_F)*np.tan(lat1))
+    U2 = np.arctan((1-WGS84_F)*np.tan(lat2))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L
+    converged = np.zeros(np.shape(L), dtype=bool)
+    for _ in range(max_iter):
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sin_sigma = np.sqrt((cosU2*sin_lam)**2 + (cosU1*sinU2 - sinU1*cosU2*cos_lam)**2)
+        cos_sigma = sinU1*sinU2 + cosU1*cosU2*cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        # coincident points have sin_sigma == 0
+        sin_alpha = np.divide(cosU1*cosU2*sin_lam, sin_sigma,
+                              out=np.zeros_like(sin_sigma), where=sin_sigma!=0)
+        cos2_alpha = 1 - sin_alpha**2
+        # equatorial lines have cos2_alpha == 0
+        cos_2sigma_m = np.where(cos2_alpha!=0, cos_sigma - np.divide(2*sinU1*sinU2, cos2_alpha,
+                                out=np.zeros_like(cos2_alpha), where=cos2_alpha!=0), 0)
+        C = WGS84_F/16*cos2_alpha*(4 + WGS84_F*(4 - 3*cos2_alpha))
+        lam_prev = lam
+        lam = L + (1-C)*WGS84_F*sin_alpha*(sigma + C*sin_sigma*(cos_2sigma_m
+                                           + C*cos_sigma*(-1 + 2*cos_2sigma_m**2)))
+        converged = np.abs(lam-lam_prev) < tol
+        if np.all(converged):
+            break
+
+    u2 = cos2_alpha*(WGS84_A**2 - WGS84_B**2)/WGS84_B**2
+    A = 1 + u2/16384*(4096 + u2*(-768 + u2*(320 - 175*u2)))
+    B = u2/1024*(256 + u2*(-128 + u2*(74 - 47*u2)))
+    delta_sigma = B*sin_sigma*(cos_2sigma_m + B/4*(cos_sigma*(-1 + 2*cos_2sigma_m**2)
+                  - B/6*cos_2sigma_m*(-3 + 4*sin_sigma**2)*(-3 + 4*cos_2sigma_m**2)))
+    s = WGS84_B*A*(sigma - delta_sigma)
+    return np.where(converged, s, np.nan)
+
+def pairwise_distance(lat1, lon1, lat2, lon2, method='vincenty'):
+    '''
+        Element-wise distance between two sets of coordinates.
+        'method' can be 'vincenty' (ellipsoidal, as accurate as geopy's
+        geodesic) or 'haversine' (spherical, fastest).
+    '''
+    if method=='haversine':
+        return haversine_distance(lat1, lon1, lat2, lon2)
+    elif method=='vincenty':
+        return vincenty_distance(lat1, lon1, lat2, lon2)
+    raise ValueError(f"unknown distance method '{method}'")
+
+def contacts_distance(contacts, method='vincenty'):
+    '''
+        Distance between source and target average position for
+        each row of the table of contacts 'contacts'.
+    '''
+    return pairwise_distance(contacts['sourceLat_avg'].to_numpy(dtype=np.float64),
+                             contacts['sourceLong_avg'].to_numpy(dtype=np.float64),
+                             contacts['targetLat_avg'].to_numpy(dtype=np.float64),
+                             contacts['targetLong_avg'].to_numpy(dtype=np.float64),
+                             method=method)
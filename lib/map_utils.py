@@ -11,6 +11,7 @@ import datetime as dt
 import graph_tool.all as gt
 import geopy.distance as gdist
 from geopy.distance import geodesic
+import lib.distance_utils as dist_utils
 from datetime import datetime
 from datetime import timedelta
 import matplotlib.pyplot as plt
@@ -21,7 +22,7 @@ from folium import FeatureGroup, LayerControl, Map, Marker
 
 Forta = pytz.timezone("America/Fortaleza")
 
-def coreComponents_on_map(folium_obj, eff_table, date, id_layer, nodecolor_dict, set_color, days_after=7, weight_filter=10, geo_precision=9):
+def coreComponents_on_map(folium_obj, eff_table, date, id_layer, nodecolor_dict, set_color, days_after=7, weight_filter=10, geo_precision=9, distance_method='vincenty'):
     '''
         Given a map, or layer, folium object, it plots circle markers for the places
         where contacts happened. The colors of the circle is related to the components
@@ -42,6 +43,9 @@ def coreComponents_on_map(folium_obj, eff_table, date, id_layer, nodecolor_dict,
         
         'set_color' is a list of HTML colors. The size of the list must be at least
         equal to the number of components of the original network.
+        
+        'distance_method' is the method used to compute the source-target distance
+        of the contacts, 'vincenty' (default) or 'haversine' (see lib/distance_utils.py).
     '''
     # For each component of the aggregated core, we create a dictionary
     # containing the contacts between the node inside the component.
@@ -53,13 +57,13 @@ def coreComponents_on_map(folium_obj, eff_table, date, id_layer, nodecolor_dict,
     ids_all = [ [] for x in range(ncomponents) ]
     
     ## ----- Calculate the points of the map ------ ##
+    # grid points - anomalies: drop all of them at once before the loop.
+    dd = dist_utils.contacts_distance(eff_table, method=distance_method)
+    eff_table = eff_table[dd>0.02]
     for index, row in eff_table.iterrows():
         src, target = row['sourceId'], row['targetId']
         lat, lon = row['targetLat_avg'], row['targetLong_avg']
-        srclat, srclon = row['sourceLat_avg'], row['sourceLong_avg']
-        dd = gdist.geodesic((lat,lon), (srclat, srclon)).m
-        if dd<=0.02: continue  # grid points - anomalies
-        src_time = datetime.fromisoformat(row['sourceTime'])
+        src_time = pd.Timestamp(row['sourceTime'])
         
         begin_interval = date - timedelta(days=0)
         final_interval = date + timedelta(days=days_after)
@@ -0,0 +1,29 @@
+import os
+import sys
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utilities import complete_lines, truncate_incomplete_line
+
+
+def test_row_cut_at_a_digit_is_not_read(tmp_path):
+    #'0.18,2.0,1.4,3' parses as a valid row although the idx was cut by a crash
+    path=tmp_path/'checkpoint.csv'
+    path.write_text('0.04,2.0,1.2,17\n0.18,2.0,1.4,3')
+    assert complete_lines(path)=='0.04,2.0,1.2,17\n'
+
+def test_appending_after_truncation_keeps_every_row(tmp_path):
+    path=tmp_path/'checkpoint.csv'
+    path.write_text('0.04,2.0,1.2,17\n0.18,2.0,1.4,3')
+    truncate_incomplete_line(path)
+    with open(path,'a') as f:
+        f.write('0.18,2.0,1.4,35\n')
+    assert path.read_text().splitlines()==['0.04,2.0,1.2,17','0.18,2.0,1.4,35']
+
+def test_empty_and_complete_logs_are_unchanged(tmp_path):
+    path=tmp_path/'checkpoint.csv'
+    path.write_text('')
+    truncate_incomplete_line(path)
+    assert complete_lines(path)==''
+    path.write_text('0.04,2.0,1.2,17\n')
+    truncate_incomplete_line(path)
+    assert path.read_text()=='0.04,2.0,1.2,17\n'
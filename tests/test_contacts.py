@@ -0,0 +1,65 @@
+import os
+import sys
+
+import random
+
+import numpy as np
+import pandas as pd
+from igraph import Graph
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utilities import graph_csr, multi_source_bfs, read_contacts, time_indexed_contacts, write_contacts
+
+
+def contacts(n=500,seed=0):
+    rng=np.random.default_rng(seed)
+    times=pd.Timestamp('2020-03-01')+pd.to_timedelta(rng.integers(0,10*86400,n),'s')
+    return pd.DataFrame({'sourceId':rng.integers(0,50,n),'targetId':rng.integers(0,50,n),'sourceTime':times})
+
+def test_window_keeps_the_rows_in_table_order():
+    table=contacts()
+    index=time_indexed_contacts(table)
+    for day in range(8):
+        start=pd.Timestamp('2020-03-01')+pd.Timedelta(days=day)
+        end=start+pd.Timedelta(days=3)
+        mask=table[(table['sourceTime']>=start)&(table['sourceTime']<end)].reset_index(drop=True)
+        window=index.window(start,end).reset_index(drop=True)
+        pd.testing.assert_frame_equal(window,mask)
+
+def test_slide_adds_and_drops_the_edge_rows():
+    table=contacts()
+    index=time_indexed_contacts(table)
+    start=pd.Timestamp('2020-03-01')
+    previous=set()
+    for day in range(0,8,2):
+        window,added,dropped=index.slide(start+pd.Timedelta(days=day),start+pd.Timedelta(days=day+7))
+        rows=set(map(tuple,window.to_numpy().tolist()))
+        assert set(map(tuple,added.to_numpy().tolist()))==rows-previous
+        assert set(map(tuple,dropped.to_numpy().tolist()))==previous-rows
+        previous=rows
+
+def test_parquet_keeps_the_order_and_dtype_of_the_rows_written(tmp_path):
+    table=contacts()
+    path=str(tmp_path/'contacts.parquet')
+    write_contacts(table.iloc[:200],path)
+    write_contacts(table.iloc[200:],path,append=True)
+    pd.testing.assert_frame_equal(read_contacts(path,columns=['sourceId','targetId','sourceTime']),table,
+                                  check_dtype=False)
+    assert read_contacts(path)['sourceId'].dtype==np.int64
+    start,end=pd.Timestamp('2020-03-02'),pd.Timestamp('2020-03-05')
+    window=table[(table['sourceTime']>=start)&(table['sourceTime']<end)].reset_index(drop=True)
+    pd.testing.assert_frame_equal(read_contacts(path,columns=['sourceId','targetId','sourceTime'],start=start,end=end),
+                                  window,check_dtype=False)
+
+def test_multi_source_bfs_matches_igraph_distances():
+    #igraph draws the graphs with the random module
+    random.seed(0)
+    rng=np.random.default_rng(0)
+    for _ in range(100):
+        n=int(rng.integers(2,80))
+        g=Graph.Erdos_Renyi(n=n,m=min(int(rng.integers(0,2*n)),n*(n-1)//2))
+        sources=rng.choice(n,int(rng.integers(1,4)),replace=True)
+        depth=int(rng.integers(0,6))
+        distance=np.min(np.asarray(g.distances(source=sources.tolist()),dtype=np.float64),axis=0)
+        expected=np.where(distance<=depth,distance,-1).astype(np.int64)
+        assert multi_source_bfs(*graph_csr(g),sources,depth).tolist()==expected.tolist()
@@ -0,0 +1,127 @@
+import os
+import sys
+import random
+
+import numpy as np
+from igraph import Graph
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utilities import giant_tracker, graph_csr, kcore_tracker, lazy_max_heap
+from COVID_19 import COVID_19
+
+
+def star_and_path():
+    #7-node star and 4-node path: removing the centre leaves 6 isolated leaves and the path
+    g=Graph([(0,i) for i in range(1,7)]+[(7,8),(8,9),(9,10)])
+    g.vs['ids']=[str(i) for i in range(g.vcount())]
+    return g
+
+def test_giant_tracker_disconnected_star():
+    g=star_and_path()
+    giant=giant_tracker(*graph_csr(g))
+    giant.remove(0)
+    reference=g.copy()
+    reference.delete_vertices(0)
+    assert giant.size==reference.components().giant().vcount()==4
+    assert giant.vertices().tolist()==[7,8,9,10]
+
+def test_giant_tracker_matches_igraph_on_disconnected_graph():
+    rng=random.Random(0)
+    g=Graph.Erdos_Renyi(n=300,m=330)
+    g.vs['v']=list(range(g.vcount()))
+    assert not g.is_connected()
+    giant=giant_tracker(*graph_csr(g))
+    h=g.copy()
+    while h.vcount()>1:
+        pos=rng.randrange(h.vcount())
+        giant.remove(giant.vertices()[pos])
+        h.delete_vertices(pos)
+        h=h.components().giant()
+        assert giant.vertices().tolist()==h.vs['v']
+
+def test_kcore_tracker_matches_igraph_coreness():
+    #igraph draws the graphs with the random module
+    random.seed(0)
+    rng=random.Random(0)
+    for _ in range(200):
+        n=rng.randint(5,60)
+        g=Graph.Erdos_Renyi(n=n,m=min(rng.randint(n//2,4*n),n*(n-1)//2))
+        tracker=kcore_tracker(*graph_csr(g))
+        alive=list(range(n))
+        rng.shuffle(alive)
+        while alive:
+            tracker.remove(alive.pop())
+            assert tracker.core[sorted(alive)].tolist()==g.induced_subgraph(sorted(alive)).coreness()
+
+def test_kcore_tracker_follows_the_giant_component():
+    #as Percolation.update_kcore: the pieces cut off are discarded with the vertex removed
+    random.seed(1)
+    rng=random.Random(1)
+    for _ in range(50):
+        g=Graph.Erdos_Renyi(n=80,m=rng.randint(80,200))
+        tracker=kcore_tracker(*graph_csr(g))
+        giant=giant_tracker(*graph_csr(g))
+        while giant.size>0:
+            v=rng.choice(giant.vertices().tolist())
+            dropped=giant.remove(v)
+            tracker.remove(v)
+            tracker.discard(dropped[dropped!=v])
+            vertices=giant.vertices().tolist()
+            assert tracker.core[vertices].tolist()==g.induced_subgraph(vertices).coreness()
+
+def brute_force_top(scores,alive):
+    #highest score among the alive vertices, the lowest vertex on ties
+    return min((i for i in range(len(scores)) if alive[i]),key=lambda i:(-scores[i],i),default=None)
+
+def test_lazy_max_heap_top_after_updates_and_removals():
+    rng=random.Random(0)
+    for _ in range(50):
+        n=rng.randint(1,40)
+        scores=[rng.randint(0,10) for _ in range(n)]
+        alive=np.ones(n,dtype=bool)
+        heap=lazy_max_heap(scores,alive)
+        while alive.any():
+            assert heap.top()==brute_force_top(scores,alive)
+            alive[rng.choice(np.flatnonzero(alive).tolist())]=False
+            nodes=rng.sample(range(n),rng.randint(0,n))
+            for i in nodes:
+                scores[i]=rng.randint(0,10)
+            heap.update(nodes,[scores[i] for i in nodes])
+        assert heap.top() is None
+
+def test_lazy_max_heap_pop_takes_the_k_highest():
+    rng=random.Random(1)
+    scores=[rng.randint(0,5) for _ in range(30)]
+    alive=np.ones(30,dtype=bool)
+    alive[::7]=False
+    heap=lazy_max_heap(scores,alive)
+    #a stale entry of an updated vertex is not returned twice
+    heap.update([3],[scores[3]+10])
+    scores[3]+=10
+    order=sorted(np.flatnonzero(alive).tolist(),key=lambda i:(-scores[i],i))
+    assert heap.pop(5)==order[:5]
+    assert heap.pop(100)==order[5:]
+    assert heap.pop(1)==[]
+
+def core_and_periphery(seed=0):
+    #dense core of 40 nodes with a sparse periphery of 160 nodes attached to it
+    rng=np.random.default_rng(seed)
+    core=rng.integers(0,40,size=(300,2))
+    periphery=np.column_stack([np.arange(40,200),rng.integers(0,200,160)])
+    edges=np.concatenate([core,periphery])
+    g=Graph(n=200,edges=edges[edges[:,0]!=edges[:,1]].tolist()).simplify().components().giant()
+    g.vs['ids']=[str(i) for i in range(g.vcount())]
+    return g
+
+def test_kcore_betweenness_batch_removes_several_core_nodes_per_step():
+    g=core_and_periphery()
+    random.seed(0)
+    G1,q1=COVID_19.Percolation(g,2).by_kcore_betweenness()
+    random.seed(0)
+    G5,q5=COVID_19.Percolation(g,2,batch=5).by_kcore_betweenness()
+    assert q1[:3]==[0,1,2]
+    assert max(np.diff(q5))<=5 and q5[1]>1
+    assert len(q5)<len(q1)
+    random.seed(0)
+    G,q=COVID_19.Percolation(g,2,batch=5,stop_q=7).by_kcore_betweenness()
+    assert q[-1]==7
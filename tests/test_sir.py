@@ -0,0 +1,45 @@
+import os
+import sys
+import random
+
+import numpy as np
+import pytest
+from igraph import Graph
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from COVID_19 import COVID_19
+
+
+def random_graph(n=300,m=900,seed=0):
+    edges=np.random.default_rng(seed).integers(0,n,size=(m,2))
+    g=Graph(n=n,edges=edges[edges[:,0]!=edges[:,1]].tolist()).simplify()
+    g.vs['ids']=[str(i) for i in range(n)]
+    return g
+
+@pytest.mark.parametrize('engine',['fast','batched','percolation'])
+def test_engines_match_the_python_engine(engine):
+    #the python engine draws from the random module
+    random.seed(0)
+    sir=COVID_19.SIR(0.3,'','test',sampling=100,seed=1)
+    table=sir.compare_engines(random_graph(),seed=0,engine=engine)
+    assert len(table)==20
+    assert table['p_value'].min()>0.01
+
+def test_compare_engines_leaves_the_instance_untouched():
+    random.seed(0)
+    sir=COVID_19.SIR(0.3,'','test',sampling=20,seed=1)
+    g=random_graph(n=50,m=100)
+    sir.g,sir.n_nodes=g,g.vcount()
+    state=sir.rng.bit_generator.state
+    sir.compare_engines(random_graph(),betas=(0.2,),seed=0,engine='fast')
+    assert sir.g is g and sir.n_nodes==50 and sir.csr is None
+    assert sir.engine=='python' and sir.samplings==20
+    assert sir.rng.bit_generator.state==state
+
+def test_run_sir_creates_the_results_folder(tmp_path):
+    g=random_graph(n=50,m=100)
+    g.vs['layer']=[0.0]*g.vcount()
+    sir=COVID_19.SIR(0.06,str(tmp_path)+'/','test',sampling=2,engine='fast',seed=0)
+    sir.run_SIR(g)
+    assert (tmp_path/'simulations_results'/'SIR_0_test_checkpoint.csv').is_file()
+    assert (tmp_path/'simulations_results'/'SIR_0_test.npy').is_file()
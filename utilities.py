@@ -1,25 +1,637 @@
 import numpy as np
 import pandas as pd
+import os
 import glob
+import shutil
 import geopy.distance as gdist
 #from geopy.distance import geodesic
 import pickle
+import heapq
 import  pytz
+from time import perf_counter
 
 
 from igraph import *
 from datetime import timedelta,datetime,time
 
 from tqdm import tqdm
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, deque
 from joblib import Parallel, delayed
 
+from lib.distance_utils import haversine_distance,vincenty_distance,pairwise_distance,contacts_distance
 
 #Local_time = pytz.timezone("America/Mexico_City")
 Local_time = pytz.timezone("America/Fortaleza")
 
 
 
+### Split a DataFrame in n row blocks (np.array_split on frames is not stable across numpy versions) ###
+def split_frame(df,n):
+    return [df.iloc[i] for i in np.array_split(np.arange(len(df)),n)]
+
+
+### sourceTime as datetime64: accepts the raw strings of the contact detector or already parsed columns ###
+def parse_source_time(source_time):
+    if pd.api.types.is_datetime64_any_dtype(source_time):
+        return source_time
+    #keep the wall-clock time (first 19 characters), the offset is the same for all the contacts
+    return pd.to_datetime(source_time.astype(str).str[:19],format='ISO8601')
+
+
+### Columnar storage of the tables of contacts ###
+#fmt='parquet' writes a directory partitioned by day (path/day=YYYY-MM-DD/*.parquet)
+#with typed ids and timestamps, fmt='csv' is kept for exports. Numeric ids stay int64,
+#as read_csv infers them in the other tables (final_edges, Infected_list). The 'row'
+#column keeps the order of the rows written, which read_contacts restores.
+def write_contacts(contacts,path,fmt='parquet',append=False):
+    if fmt=='csv':
+        contacts.to_csv(path,mode='a' if append else 'w',header=not append)
+        return path
+    if not append and os.path.isdir(path):
+        shutil.rmtree(path)
+    offset=parquet_dataset(path).count_rows() if append and os.path.isdir(path) else 0
+    contacts=contacts.reset_index(drop=True)
+    contacts['row']=np.arange(offset,offset+len(contacts),dtype=np.int64)
+    contacts['sourceTime']=parse_source_time(contacts['sourceTime'])
+    for col in ['sourceId','targetId']:
+        #an object column can mix types across the chunks of a csv, arrow needs one
+        if contacts[col].dtype==object:
+            contacts[col]=contacts[col].astype(str)
+    contacts['day']=contacts['sourceTime'].dt.strftime('%Y-%m-%d')
+    contacts.drop(columns=[i for i in contacts.columns if str(i).startswith('Unnamed:')]).to_parquet(
+                  path,partition_cols=['day'],index=False)
+    return path
+
+#pyarrow dataset of a table written by write_contacts (metadata only, nothing is read)
+def parquet_dataset(path):
+    import pyarrow.dataset as ds
+    return ds.dataset(path,format='parquet',partitioning='hive')
+
+def read_contacts(path,columns=None,start=None,end=None):
+    #only the contacts with start<=sourceTime<end are returned (if given)
+    if os.path.isdir(path):
+        filters=[]
+        if start is not None:
+            filters.append(('day','>=',pd.Timestamp(start).strftime('%Y-%m-%d')))
+        if end is not None:
+            filters.append(('day','<=',pd.Timestamp(end).strftime('%Y-%m-%d')))
+        ordered='row' in parquet_dataset(path).schema.names
+        _columns=None if columns is None else list(dict.fromkeys(list(columns)+['sourceTime']+(['row'] if ordered else [])))
+        contacts=pd.read_parquet(path,columns=_columns,filters=filters if filters else None)
+        if ordered:
+            #the partitions come back one day after the other: back to the order of the rows written
+            contacts=contacts.iloc[np.argsort(contacts['row'].to_numpy(),kind='stable')].drop(columns=['row'])
+        if 'day' in contacts.columns and (columns is None or 'day' not in columns):
+            contacts=contacts.drop(columns=['day'])
+    else:
+        usecols=None if columns is None else (lambda c: c in columns or c=='sourceTime')
+        contacts=pd.read_csv(path,usecols=usecols)
+        contacts['sourceTime']=parse_source_time(contacts['sourceTime'])
+    if start is not None:
+        contacts=contacts[contacts['sourceTime']>=pd.Timestamp(start)]
+    if end is not None:
+        contacts=contacts[contacts['sourceTime']<pd.Timestamp(end)]
+    if columns is not None:
+        contacts=contacts[list(columns)]
+    return contacts.reset_index(drop=True)
+
+
+### Membership of the ids of `column` in `ids`, read from different tables ###
+#numeric ids are inferred as int64 by read_csv, the ids are compared as strings only if one side is not numeric
+def isin_ids(column,ids):
+    column,ids=pd.Series(column),pd.Index(ids)
+    if pd.api.types.is_numeric_dtype(column)!=pd.api.types.is_numeric_dtype(ids):
+        column,ids=column.astype(str),ids.astype(str)
+    return column.isin(ids).to_numpy()
+
+
+### Append-only csv logs (checkpoints): a line is complete only once its newline is written ###
+#a line cut by a crash can still parse (e.g. a number cut at a digit), so it is never read
+def complete_lines(path):
+    with open(path) as f:
+        text=f.read()
+    return text[:text.rfind('\n')+1]
+
+#drops the line cut by a crash before appending new lines to the log
+def truncate_incomplete_line(path):
+    with open(path,'rb+') as f:
+        data=f.read()
+        f.truncate(data.rfind(b'\n')+1)
+
+
+### CSR adjacency (indptr,indices) of the undirected edges (src[i],tgt[i]) over the nodes 0..n-1 ###
+def csr_adjacency(src,tgt,n):
+    src,tgt=np.asarray(src,dtype=np.int64),np.asarray(tgt,dtype=np.int64)
+    rows,cols=np.concatenate([src,tgt]),np.concatenate([tgt,src])
+    order=np.argsort(rows,kind='stable')
+    indptr=np.zeros(n+1,dtype=np.int64)
+    np.cumsum(np.bincount(rows,minlength=n),out=indptr[1:])
+    return indptr,cols[order]
+
+### Neighbours of all the nodes in 'nodes' (concatenated, with repetitions) ###
+def csr_neighbors(indptr,indices,nodes):
+    starts=indptr[nodes]
+    counts=indptr[np.asarray(nodes)+1]-starts
+    offsets=np.repeat(starts-np.cumsum(counts)+counts,counts)+np.arange(np.sum(counts))
+    return indices[offsets]
+
+### Distance (layer) of each node from the set 'sources', -1 if farther than max_depth ###
+def multi_source_bfs(indptr,indices,sources,max_depth):
+    layer=np.full(len(indptr)-1,-1,dtype=np.int64)
+    frontier=np.unique(sources)
+    layer[frontier]=0
+    for d in range(1,max_depth+1):
+        if len(frontier)==0:
+            break
+        nbs=csr_neighbors(indptr,indices,frontier)
+        frontier=np.unique(nbs[layer[nbs]<0])
+        layer[frontier]=d
+    return layer
+
+
+### CSR adjacency of an igraph graph ###
+def graph_csr(g):
+    edges=np.asarray(g.get_edgelist(),dtype=np.int64).reshape(-1,2)
+    return csr_adjacency(edges[:,0],edges[:,1],g.vcount())
+
+### Connected components with a vectorized union-find (hooking on the smaller root + path compression) ###
+def union_find_labels(n,src,tgt):
+    return union_find_merge(np.arange(n),src,tgt)
+
+### Adds the edges (src,tgt) to a compressed union-find forest 'parent', e.g. as returned by union_find_labels ###
+def union_find_merge(parent,src,tgt):
+    parent=np.array(parent)
+    src,tgt=np.asarray(src,dtype=np.int64),np.asarray(tgt,dtype=np.int64)
+    while len(src)>0:
+        ru,rv=parent[src],parent[tgt]
+        lo,hi=np.minimum(ru,rv),np.maximum(ru,rv)
+        keep=lo!=hi
+        if not np.any(keep):
+            break
+        #only edges joining two different trees are needed in the next rounds
+        src,tgt,lo,hi=src[keep],tgt[keep],lo[keep],hi[keep]
+        np.minimum.at(parent,hi,lo)
+        while True:
+            grand=parent[parent]
+            if np.array_equal(grand,parent):
+                break
+            parent=grand
+    return parent
+
+### Two-sample Kolmogorov-Smirnov statistic and asymptotic p-value ###
+def ks_2samp(x,y):
+    x,y=np.sort(np.asarray(x,dtype=np.float64)),np.sort(np.asarray(y,dtype=np.float64))
+    grid=np.concatenate([x,y])
+    D=np.max(np.abs(np.searchsorted(x,grid,side='right')/len(x)-np.searchsorted(y,grid,side='right')/len(y)))
+    ne=len(x)*len(y)/(len(x)+len(y))
+    lam=(np.sqrt(ne)+0.12+0.11/np.sqrt(ne))*D
+    if lam==0:
+        return D,1.0
+    k=np.arange(1,101)
+    return D,float(np.clip(2*np.sum((-1.0)**(k-1)*np.exp(-2*(k*lam)**2)),0,1))
+
+
+### Undirected edge deduplication: first occurrence of each pair, in its original orientation and order ###
+def unique_undirected_edges(src,tgt):
+    src,tgt=np.asarray(src,dtype=np.int64),np.asarray(tgt,dtype=np.int64)
+    if len(src)==0:
+        return np.empty((0,2),dtype=np.int64)
+    n=max(src.max(),tgt.max())+1
+    key=np.minimum(src,tgt)*n+np.maximum(src,tgt)
+    _,first=np.unique(key,return_index=True)
+    first=np.sort(first)
+    return np.column_stack([src[first],tgt[first]])
+
+### Quadratic list-based deduplication, as done originally in build_contact_network (reference only) ###
+def unique_undirected_edges_list(edges):
+    un,unique_connections_clean=[],[]
+    for j in edges:
+        if ((j[0],j[1]) not in un) and ((j[1],j[0]) not in un):
+            un.append((j[0],j[1]))
+            un.append((j[1],j[0]))
+            unique_connections_clean.append((j[0],j[1]))
+    return unique_connections_clean
+
+### Benchmark of the edge deduplication on the sizes of contact_networks/g_*.gml ###
+def benchmark_edge_dedup(folder,pattern='contact_networks/g_*.gml',repeats=3,reference_limit=4000,seed=0):
+    #each edge of the network is repeated 'repeats' times with random orientation, as
+    #the same contact is seen several times in a window. The quadratic reference is
+    #timed on the first 'reference_limit' contacts only and extrapolated as O(E^2).
+    rng=np.random.default_rng(seed)
+    report=[]
+    for fname in sorted(glob.glob(folder+pattern)):
+        edges=np.asarray(Graph.Read_GML(fname).get_edgelist(),dtype=np.int64)
+        contacts=np.repeat(edges,repeats,axis=0)
+        contacts=contacts[rng.permutation(len(contacts))]
+        flip=rng.random(len(contacts))<0.5
+        contacts[flip]=contacts[flip][:,::-1]
+        t0=perf_counter()
+        fast=unique_undirected_edges(contacts[:,0],contacts[:,1])
+        t_fast=perf_counter()-t0
+        sub=contacts[:reference_limit]
+        t0=perf_counter()
+        reference=unique_undirected_edges_list([tuple(i) for i in sub])
+        t_ref=(perf_counter()-t0)*(len(contacts)/len(sub))**2
+        same=np.array_equal(np.asarray(reference,dtype=np.int64).reshape(-1,2),
+                            unique_undirected_edges(sub[:,0],sub[:,1]))
+        report.append({'file':fname.split('/')[-1],'contacts':len(contacts),'edges':len(fast),
+                       'vectorized_s':t_fast,'list_s_estimated':t_ref,'speedup':t_ref/t_fast,'identical':same})
+    return pd.DataFrame(report)
+
+
+### Binary graph cache: edge list, ids and layer of the contact networks in a .npz file ###
+def write_graph_npz(g,path):
+    edges=np.asarray(g.get_edgelist(),dtype=np.int64).reshape(-1,2)
+    dtype=np.int32 if g.vcount()<np.iinfo(np.int32).max else np.int64
+    #numeric ids are kept as they are, the others stored as utf-8 bytes
+    ids=np.asarray(g.vs['ids'])
+    ids=ids if ids.dtype.kind in 'iuf' else np.char.encode(ids.astype(str),'utf-8')
+    np.savez(path,n=np.int64(g.vcount()),edges=edges.astype(dtype),ids=ids,
+             layer=np.asarray(g.vs['layer'],dtype=np.float64))
+    return path
+
+def read_graph_arrays(path):
+    #plain arrays: {'n','edges','ids','layer'}
+    with np.load(path) as data:
+        ids=data['ids'] if data['ids'].dtype.kind in 'iuf' else np.char.decode(data['ids'],'utf-8')
+        return {'n':int(data['n']),'edges':data['edges'],'ids':ids,'layer':data['layer']}
+
+def load_graph(path,backend='igraph'):
+    """ 
+        Loads a contact network saved as .npz (write_graph_npz) or .gml
+        as an igraph ('igraph') or graph-tool ('graph-tool') object.
+        Both of them carry the 'ids' and 'layer' vertex properties.
+    """
+    if path.endswith('.gml'):
+        if backend=='igraph':
+            return Graph.Read_GML(path)
+        import graph_tool.all as gt
+        return gt.load_graph(path)
+    data=read_graph_arrays(path)
+    if backend=='igraph':
+        g=Graph(n=data['n'],edges=data['edges'].tolist(),directed=False)
+        g.vs['ids']=data['ids'].tolist()
+        g.vs['layer']=data['layer'].tolist()
+        return g
+    import graph_tool.all as gt
+    g=gt.Graph(directed=False)
+    g.add_vertex(data['n'])
+    g.add_edge_list(data['edges'])
+    kind={'i':'int64_t','u':'int64_t','f':'double'}.get(data['ids'].dtype.kind,'string')
+    g.vp.ids=g.new_vertex_property(kind,vals=data['ids'].tolist())
+    g.vp.layer=g.new_vertex_property('double',vals=data['layer'])
+    return g
+
+### GML export of a cached graph (and conversion of an existing folder of GML files) ###
+def export_gml(path_npz,path_gml=None):
+    path_gml=path_npz[:-len('.npz')]+'.gml' if path_gml==None else path_gml
+    load_graph(path_npz).write_gml(path_gml)
+    return path_gml
+
+def convert_gml_folder(folder):
+    return [write_graph_npz(Graph.Read_GML(i),i[:-len('.gml')]+'.npz') for i in sorted(glob.glob(folder+'*.gml'))]
+
+
+### Contacts sorted once by sourceTime: [start,end) windows are binary searches returning slices ###
+#the rows of a window are returned in their order in the input table, as a boolean mask would
+class time_indexed_contacts:
+    def __init__(self,contacts,time_column='sourceTime'):
+        order=np.argsort(contacts[time_column].to_numpy(),kind='stable')
+        self.contacts=contacts.iloc[order].reset_index(drop=True)
+        self.order=order
+        self.times=self.contacts[time_column].to_numpy()
+        self.bounds=None
+    def __len__(self):
+        return len(self.times)
+    def locate(self,start,end):
+        #row range [lo,hi) of the contacts with start<=time<end, O(log n)
+        lo,hi=np.searchsorted(self.times,np.asarray([start,end],dtype=self.times.dtype))
+        return int(lo),int(hi)
+    def rows(self,lo,hi):
+        #sorted rows lo..hi-1 back in the order of the input table
+        return self.contacts.iloc[lo+np.argsort(self.order[lo:hi],kind='stable')]
+    def window(self,start,end):
+        lo,hi=self.locate(start,end)
+        self.bounds=(lo,hi)
+        return self.rows(lo,hi)
+    def slide(self,start,end):
+        """ 
+            Moves the current window to [start,end) and returns to
+            (window, added, dropped): the new window and the contacts
+            that entered it or left it with respect to the previous one.
+            Only the edge rows are touched.
+        """
+        lo,hi=self.locate(start,end)
+        if self.bounds is None:
+            added,dropped=self.rows(lo,hi),self.contacts.iloc[0:0]
+        else:
+            _lo,_hi=self.bounds
+            added=pd.concat([self.rows(lo,min(hi,_lo)),self.rows(max(lo,_hi),hi)])
+            dropped=pd.concat([self.rows(_lo,min(_hi,lo)),self.rows(max(_lo,hi),_hi)])
+        self.bounds=(lo,hi)
+        return self.rows(lo,hi),added,dropped
+
+### Core numbers of a CSR graph kept up to date while vertices are removed ###
+class kcore_tracker:
+    def __init__(self,indptr,indices,core=None):
+        self.indptr,self.indices=np.asarray(indptr).tolist(),np.asarray(indices).tolist()
+        n=len(self.indptr)-1
+        if core is None:
+            src=np.repeat(np.arange(n),np.diff(indptr))
+            mask=src<np.asarray(indices)
+            core=Graph(n,np.column_stack([src[mask],np.asarray(indices)[mask]]).tolist()).coreness()
+        self.core=np.array(core,dtype=np.int64)
+        self.alive=np.ones(n,dtype=bool)
+    def remove(self,v):
+        """
+            Deletes the vertex 'v' and updates the core numbers.
+            The core of any other vertex drops at most by one, and only
+            for vertices of core K<=core(v): for each K the peeling is
+            restarted from the neighbours of 'v' and follows the cascade
+            of vertices left with less than K neighbours of core >=K,
+            the rest of the graph is not visited.
+        """
+        indptr,indices,core,alive=self.indptr,self.indices,self.core,self.alive
+        alive[v]=False
+        kv=core[v]
+        nbs=[u for u in indices[indptr[v]:indptr[v+1]] if alive[u] and core[u]<=kv]
+        for K in set(core[nbs].tolist()):
+            #neighbours of core >=K, counted when a vertex is first reached
+            cd={}
+            evict=[u for u in nbs if core[u]==K]
+            while evict:
+                s=evict.pop()
+                if core[s]!=K:
+                    continue
+                if s not in cd:
+                    cd[s]=sum(1 for t in indices[indptr[s]:indptr[s+1]] if alive[t] and core[t]>=K)
+                if cd[s]>=K:
+                    continue
+                core[s]=K-1
+                for t in indices[indptr[s]:indptr[s+1]]:
+                    if alive[t] and core[t]==K:
+                        if t in cd:
+                            cd[t]-=1
+                        evict.append(t)
+    def discard(self,nodes):
+        #vertices dropped with whole components: the cores of the others are not affected
+        self.alive[np.asarray(nodes,dtype=np.int64)]=False
+
+### Giant component of a CSR graph kept up to date while vertices are removed ###
+class giant_tracker:
+    def __init__(self,indptr,indices):
+        self.indptr,self.indices=np.asarray(indptr).tolist(),np.asarray(indices).tolist()
+        n=len(self.indptr)-1
+        self.alive=np.ones(n,dtype=bool)
+        self.size=n
+        src=np.repeat(np.arange(n),np.diff(indptr))
+        #a graph with more components is reduced to its giant at the first removal
+        self.connected=len(np.unique(union_find_labels(n,src,np.asarray(indices))))<=1
+    def vertices(self):
+        #vertices of the giant component, in the order of the vertices of the graph
+        return np.flatnonzero(self.alive)
+    def largest(self,pieces):
+        #largest piece, the one with the lowest vertex on ties (as igraph giant())
+        return max(pieces,key=lambda i: (len(i),-min(i)))
+    def split(self,v):
+        """
+            Pieces of the giant component left by the removal of 'v':
+            one BFS per neighbour of 'v', advanced one vertex at a time.
+            A search reaching a vertex of another search is merged into
+            it, and the searches stop when at most one is still running:
+            only the pieces cut off are fully visited. Returns to
+            (finished pieces, vertices of the running search or None).
+        """
+        indptr,indices,alive=self.indptr,self.indices,self.alive
+        nbs=list(dict.fromkeys(u for u in indices[indptr[v]:indptr[v+1]] if alive[u]))
+        owner={u:i for i,u in enumerate(nbs)}
+        merged=list(range(len(nbs)))
+        queues=[deque([u]) for u in nbs]
+        visited=[[u] for u in nbs]
+        active,finished=list(range(len(nbs))),[]
+        def find(i):
+            while merged[i]!=i:
+                i=merged[i]
+            return i
+        while len(active)>1:
+            for i in list(active):
+                if merged[i]!=i:
+                    continue
+                if not queues[i]:
+                    active.remove(i)
+                    finished.append(visited[i])
+                    continue
+                s,cur=queues[i].popleft(),i
+                for t in indices[indptr[s]:indptr[s+1]]:
+                    if not alive[t]:
+                        continue
+                    o=owner.get(t)
+                    if o is None:
+                        owner[t]=cur
+                        visited[cur].append(t)
+                        queues[cur].append(t)
+                    elif find(o)!=cur:
+                        #same component: the search continues as the other one
+                        r=find(o)
+                        merged[cur]=r
+                        queues[r].extend(queues[cur])
+                        visited[r].extend(visited[cur])
+                        active.remove(cur)
+                        cur=r
+                if len(active)<=1:
+                    break
+        return finished,(visited[active[0]] if active else None)
+    def remove(self,v):
+        """
+            Deletes the vertex 'v' of the giant component and drops the
+            pieces cut off from it. Returns to the sorted dropped
+            vertices, 'v' included. Only the pieces visited by split
+            are touched, unless the piece kept is one of them.
+        """
+        if not self.connected:
+            before=self.alive.copy()
+            self.alive[v]=False
+            src,tgt=np.repeat(np.arange(len(self.alive)),np.diff(self.indptr)),np.asarray(self.indices)
+            #edges of the removed vertex no longer join its neighbours
+            keep=self.alive[src]&self.alive[tgt]
+            labels=union_find_labels(len(self.alive),src[keep],tgt[keep])
+            labels[~self.alive]=-1
+            counts=np.bincount(labels[labels>=0],minlength=len(self.alive))
+            #in place: the alive mask can be shared with other structures
+            self.alive[:]=labels==np.argmax(counts) if np.any(counts) else self.alive
+            self.connected=True
+            dropped=np.flatnonzero(before & ~self.alive)
+        else:
+            self.alive[v]=False
+            finished,running=self.split(v)
+            dropped=[np.asarray([v])]
+            if finished:
+                rest=self.size-1-sum(len(i) for i in finished)
+                keep=self.largest(finished)
+                if running is not None and (rest>len(keep) or (rest==len(keep) and
+                                            self.rest_minimum(finished)<min(keep))):
+                    for i in finished:
+                        self.alive[i]=False
+                    dropped+=[np.asarray(i) for i in finished]
+                else:
+                    others=np.flatnonzero(self.alive)
+                    self.alive[others]=False
+                    self.alive[keep]=True
+                    dropped.append(np.setdiff1d(others,keep))
+            dropped=np.sort(np.concatenate(dropped).astype(np.int64))
+        self.size-=len(dropped)
+        return dropped
+    def rest_minimum(self,finished):
+        #lowest vertex of the part of the giant component not visited by split
+        alive=self.alive.copy()
+        for i in finished:
+            alive[i]=False
+        return np.flatnonzero(alive)[0]
+
+### Giant component sizes along a fixed removal order, adding the nodes back in reverse order with a union-find ###
+#sizes[q] is the size of the giant component once the first q nodes of 'order' are removed
+def reverse_percolation(indptr,indices,order):
+    indptr,indices=np.asarray(indptr).tolist(),np.asarray(indices).tolist()
+    n=len(indptr)-1
+    parent,size=list(range(n)),[1]*n
+    present=[False]*n
+    def find(i):
+        while parent[i]!=i:
+            parent[i]=parent[parent[i]]
+            i=parent[i]
+        return i
+    def add(v):
+        present[v]=True
+        for u in indices[indptr[v]:indptr[v+1]]:
+            if present[u]:
+                ru,rv=find(u),find(v)
+                if ru!=rv:
+                    if size[ru]<size[rv]:
+                        ru,rv=rv,ru
+                    parent[rv]=ru
+                    size[ru]+=size[rv]
+        return size[find(v)]
+    order=np.asarray(order,dtype=np.int64).tolist()
+    removed=set(order)
+    best=0
+    for v in range(n):
+        if v not in removed:
+            best=max(best,add(v))
+    sizes=np.zeros(len(order)+1,dtype=np.int64)
+    for q in range(len(order),0,-1):
+        sizes[q]=best
+        best=max(best,add(order[q-1]))
+    sizes[0]=best
+    return sizes
+
+### Vertices at distance <=rad from v among the alive vertices of a CSR graph, as {vertex:distance} ###
+def csr_ball(indptr,indices,alive,v,rad):
+    dist={v:0}
+    frontier=[v]
+    for d in range(1,rad+1):
+        nxt=[]
+        for s in frontier:
+            for t in indices[indptr[s]:indptr[s+1]]:
+                if alive[t] and t not in dist:
+                    dist[t]=d
+                    nxt.append(t)
+        frontier=nxt
+    return dist
+
+### Collective influence CI(v)=(k_v-1)*sum(k_j-1) over the vertices j at distance rad from v ###
+#The BFS marks are stamps in one array allocated once: a vertex is visited by the current
+#BFS if its stamp is the current one, so nothing is cleared or allocated between two nodes.
+class ci_engine:
+    def __init__(self,indptr,indices,alive=None):
+        self.indptr,self.indices=np.asarray(indptr).tolist(),np.asarray(indices).tolist()
+        n=len(self.indptr)-1
+        #can be shared with a giant_tracker, see Percolation.attack_heap
+        self.alive=np.ones(n,dtype=bool) if alive is None else alive
+        self.seen=[0]*n
+        self.stamp=0
+    def boundary(self,v,rad):
+        #alive vertices at distance rad from v
+        if rad<1:
+            return []
+        indptr,indices,alive,seen=self.indptr,self.indices,self.alive,self.seen
+        self.stamp+=1
+        stamp=self.stamp
+        seen[v]=stamp
+        frontier=[v]
+        for _ in range(rad):
+            nxt=[]
+            for s in frontier:
+                for t in indices[indptr[s]:indptr[s+1]]:
+                    if seen[t]!=stamp and alive[t]:
+                        seen[t]=stamp
+                        nxt.append(t)
+            frontier=nxt
+        return frontier
+    def ci(self,v,rad,degree):
+        if degree[v]<=1:
+            return 0
+        return (degree[v]-1)*sum(degree[j]-1 for j in self.boundary(v,rad))
+    def all(self,rad,degree=None,nodes=None):
+        #CI of 'nodes' (all the vertices by default), degree as number of neighbours if not given
+        degree=np.diff(self.indptr).tolist() if degree is None else degree
+        nodes=range(len(self.seen)) if nodes is None else nodes
+        return [self.ci(v,rad,degree) for v in nodes]
+
+#all the nodes in one pass, split in blocks over 'cores' workers
+def collective_influence(indptr,indices,rad,cores=1):
+    n=len(indptr)-1
+    if cores==1:
+        return np.asarray(ci_engine(indptr,indices).all(rad),dtype=np.int64)
+    blocks=np.array_split(np.arange(n),cores)
+    CI=Parallel(n_jobs=cores)(delayed(_ci_block)(indptr,indices,rad,i) for i in blocks)
+    return np.asarray(np.concatenate(CI),dtype=np.int64)
+
+def _ci_block(indptr,indices,rad,nodes):
+    return ci_engine(indptr,indices).all(rad,nodes=nodes.tolist())
+
+### Position of the highest score among the highest core values (first on ties), None if that score is not positive ###
+def argmax_core_score(core,score):
+    core,score=np.asarray(core),np.asarray(score,dtype=np.float64)
+    if len(core)==0:
+        return None
+    score=np.where(core==core.max(),score,-np.inf)
+    i=int(np.argmax(score))
+    return i if score[i]>0 else None
+
+### Max-heap of vertex scores with lazy deletion ###
+#updated scores are pushed again: a popped entry is discarded if its vertex is
+#no longer alive or its score is not the current one. Ties go to the lowest vertex.
+class lazy_max_heap:
+    def __init__(self,scores,alive):
+        self.scores=list(scores)
+        self.alive=alive
+        self.heap=[(-s,i) for i,s in enumerate(self.scores)]
+        heapq.heapify(self.heap)
+    def update(self,vertices,scores):
+        for i,s in zip(vertices,scores):
+            if s!=self.scores[i]:
+                self.scores[i]=s
+                heapq.heappush(self.heap,(-s,i))
+    def top(self):
+        while self.heap:
+            s,i=self.heap[0]
+            if self.alive[i] and -s==self.scores[i]:
+                return i
+            heapq.heappop(self.heap)
+        return None
+    def pop(self,k):
+        #the k highest vertices, taken out of the heap
+        out=[]
+        while len(out)<k:
+            i=self.top()
+            if i is None:
+                break
+            heapq.heappop(self.heap)
+            if i not in out:
+                out.append(i)
+        return out
+
+
 ### Load daily Grandata ###
 def load_day(i):
     dtypes = {'id': 'str', 'lat': 'float', 'long': 'float', 'datastamp': 'int64'}
@@ -64,17 +676,28 @@ def write_pickle(_input,_output):
 
 
 ### Compute the msrd for a given users ###
-def get_user_rms(user_lat, user_lon, user_time):
+def get_user_rms(user_lat, user_lon, user_time, method='vincenty'):
     num_points = len(user_time)
     if num_points<10:
         return (user_time[0], user_time[-1], np.nan)
-    d = 0
-    for k in range(0, num_points-1):
-        dx = gdist.geodesic((user_lat[k], user_lon[k]), (user_lat[k+1], user_lon[k+1])).m
-        d += dx*dx
+    lat,lon=np.asarray(user_lat,dtype=np.float64),np.asarray(user_lon,dtype=np.float64)
+    dx = pairwise_distance(lat[:-1],lon[:-1],lat[1:],lon[1:],method=method)
+    d = np.sum(dx*dx)
     rms = np.sqrt((d/num_points))
     return (user_time[0], user_time[-1], rms)
 
+### Check that the vectorized grid filter keeps the same rows as geodesic ###
+def check_grid_filter(contacts,cutoff=0.1,method='vincenty',sample=None,seed=0):
+    if sample is not None and sample<len(contacts):
+        contacts=contacts.sample(n=sample,random_state=seed)
+    reference=np.asarray([gdist.geodesic((i['sourceLat_avg'],i['sourceLong_avg']),
+                                         (i['targetLat_avg'],i['targetLong_avg'])).m
+                          for _,i in contacts.iterrows()])
+    fast=contacts_distance(contacts,method=method)
+    mismatch=np.count_nonzero((reference>cutoff)!=(fast>cutoff))
+    return {'rows':len(contacts),'mismatched_rows':mismatch,
+            'max_abs_error_m':np.max(np.abs(reference-fast)) if len(contacts)>0 else 0.0}
+
 ### load pickle files ###
 def unpack_users_timeline(path):
     with open(path, 'rb') as handle:
@@ -102,6 +725,11 @@ def filtering(minus,plus,final_list,infected_list):
 
 ### For the kcore_betweeness percolation ###
 def calculate_out_core(g, deg, start_core, kcore):
+    nodes = out_core_nodes(g, deg, start_core, kcore, 1)
+    return nodes[0] if nodes else -1
+
+#the `size` core nodes with a neighbour outside the core of highest degree, in the order of calculate_out_core
+def out_core_nodes(g, deg, start_core, kcore, size):
     core_nodes = [ v for v,_ in enumerate(g.vs['ids']) if kcore[v]>=start_core ]
     # Select only core nodes that have neighbor outside the core.
     valid_nodes = []
@@ -115,17 +743,58 @@ def calculate_out_core(g, deg, start_core, kcore):
     # Get the total degree of the valid nodes. ### CHOOSE 'total', 'in' or 'out'.
     deg_valid_nodes = [ deg[v] for v in valid_nodes ]
     order = np.argsort(deg_valid_nodes)[::-1]
-    for ind in order:
-        return valid_nodes[ind]
+    return [ valid_nodes[ind] for ind in order[:size] ]
+
+### Pivot sampling betweenness: exact dependencies from k random sources, rescaled by n/k ###
+#Number of pivots bounding by epsilon the error on the betweenness normalized by n(n-2)/2, with
+#probability 1-delta (Hoeffding and union bound on the n vertices). k>=n means exact betweenness.
+def betweenness_pivots(n,epsilon=0.05,delta=0.1):
+    return int(np.ceil(np.log(2*n/delta)/(2*epsilon**2)))
+
+#seed: int or np.random.Generator
+def approximate_betweenness(g,epsilon=0.05,delta=0.1,seed=None):
+    n=g.vcount()
+    k=betweenness_pivots(max(n,1),epsilon,delta)
+    if k>=n:
+        return g.betweenness(directed=False)
+    pivots=np.random.default_rng(seed).choice(n,k,replace=False)
+    return (np.asarray(g.betweenness(directed=False,sources=pivots.tolist()))*n/k).tolist()
+
+### Approximate vs exact betweenness rankings on the networks folder+pattern ###
+#graph_format: 'npz' or 'gml', as written by contact_network
+def validate_betweenness(folder,graph_format='npz',pattern=None,epsilon=0.05,delta=0.1,seed=0,top=10):
+    pattern=f'contact_networks/gc_*.{graph_format}' if pattern is None else pattern
+    rows=[]
+    for path in sorted(glob.glob(folder+pattern),key=lambda i:int(i.split('_')[-1].split('.')[0])):
+        g=load_graph(path)
+        n=g.vcount()
+        t0=perf_counter()
+        exact=np.asarray(g.betweenness(directed=False))
+        t1=perf_counter()
+        approx=np.asarray(approximate_betweenness(g,epsilon,delta,seed))
+        t2=perf_counter()
+        top_exact,top_approx=np.argsort(-exact,kind='stable')[:top],np.argsort(-approx,kind='stable')[:top]
+        rows.append({'network':os.path.basename(path),'nodes':n,'pivots':min(betweenness_pivots(n,epsilon,delta),n),
+                     'max_error':np.max(np.abs(approx-exact))/(n*(n-2)/2),
+                     'spearman':pd.Series(exact).corr(pd.Series(approx),method='spearman'),
+                     'top_overlap':len(set(top_exact)&set(top_approx))/top,
+                     'same_max':bool(np.argmax(exact)==np.argmax(approx)),
+                     'exact_seconds':t1-t0,'approx_seconds':t2-t1})
+    return pd.DataFrame(rows)
 
 ### define nodes with the Highet BC in a given layer(s) ###
-def node_in_layer(g,layers=None):
+#btw: betweenness of the nodes of g, computed (exact) if not given
+def node_in_layer(g,layers=None,btw=None):
     if layers==None:
-        _name=g.vs.select(_betweenness = np.max(g.betweenness(directed=False)))['ids'][0]
-        _ids=g.vs["ids"].index(_name)
+        if btw is None:
+            _name=g.vs.select(_betweenness = np.max(g.betweenness(directed=False)))['ids'][0]
+            _ids=g.vs["ids"].index(_name)
+        else:
+            _ids=int(np.argmax(btw))
+            _name=g.vs[_ids]['ids']
         return _name,_ids
     else:
-        btw=g.betweenness(directed=False)
+        btw=g.betweenness(directed=False) if btw is None else btw
         layer=g.vs['layer']
         btw_l,_ids=[],[]
         for i,ii in enumerate(layer):